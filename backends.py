@@ -0,0 +1,160 @@
+# backends.py
+# Detector inference backends: the PyTorch checkpoint, a TorchScript model or an ONNX model run by onnxruntime on CPU,
+# both exported by models/export.py --grid (or the int8 TorchScript model of quantize.py). Every backend maps a
+# (bs,3,h,w) model input to the (bs,n,5+nc) raw predictions that non_max_suppression() takes, so the backends are
+# interchangeable behind my_functions.Detector. The helmet classifier loads the same way, see load_classifier()
+
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models.experimental import attempt_load
+from utils.torch_utils import inference_mode
+
+backends = ('torch', 'torchscript', 'onnx')
+
+
+def backend_type(weights, backend='auto'):
+    # Backend of weights, from the file suffix for backend='auto'
+    if backend != 'auto':
+        assert backend in backends, f'unknown backend {backend}, use one of {list(backends)} or auto'
+        return backend
+    w = str(weights)
+    if w.endswith('.onnx'):
+        return 'onnx'
+    if w.endswith(('.torchscript.pt', '.torchscript')):
+        return 'torchscript'
+    return 'torch'
+
+
+def load_backend(weights, backend='auto', device='cpu', dtype=torch.float32):
+    # Load weights with the backend of backend_type()
+    backend = backend_type(weights, backend)
+    if backend == 'torch':
+        return TorchBackend(weights, device, dtype)
+    assert dtype == torch.float32, f'{backend} models are exported in fp32, use precision fp32'
+    return (TorchScriptBackend if backend == 'torchscript' else OnnxBackend)(weights, device)
+
+
+def load_classifier(weights, backend='auto', device='cpu', dtype=torch.float32):
+    # Load the helmet classifier (model2), a pickled module, its TorchScript or its ONNX export of models/export.py
+    # --classifier. Returns a model mapping a (n,3,h,w) input to (n,2) logits
+    backend = backend_type(weights, backend)
+    if backend == 'torch':
+        with inference_mode(False), torch.no_grad():  # normal leaf tensors, even if first used in inference mode
+            model = torch.load(weights, map_location=device)  # ... may need full path
+            model.eval()
+            model.requires_grad_(False)
+            model.to(dtype=dtype, memory_format=torch.channels_last)
+        return model
+    assert dtype == torch.float32, f'{backend} models are exported in fp32, use precision fp32'
+    if backend == 'torchscript':
+        return torch.jit.load(weights, map_location=device).eval()
+    return OnnxClassifier(weights, device)
+
+
+def onnx_run(session, x, device):
+    # Run an onnxruntime session on tensor x, returns its first output as a tensor on device
+    x = np.ascontiguousarray(x.cpu().numpy(), dtype=np.float32)
+    y = session.run([session.get_outputs()[0].name], {session.get_inputs()[0].name: x})[0]
+    return torch.from_numpy(y).to(device)
+
+
+class TorchBackend:
+    # PyTorch checkpoint, any stride-multiple input shape and precision
+    name = 'torch'
+
+    def __init__(self, weights, device='cpu', dtype=torch.float32):
+        with inference_mode(False), torch.no_grad():  # normal leaf tensors, even if first used in inference mode
+            self.model = attempt_load(weights, map_location=device)
+            self.model.requires_grad_(False)
+            self.model.to(dtype=dtype, memory_format=torch.channels_last)
+        self.names = self.model.module.names if hasattr(self.model, 'module') else self.model.names
+        self.stride = int(self.model.stride.max())  # model stride
+        self.shape = None  # fixed input (h, w), None for any shape
+        self.nms = None  # raw predictions
+
+    def to(self, dtype):
+        self.model.to(dtype=dtype, memory_format=torch.channels_last)
+
+    def __call__(self, img):
+        return self.model(img, augment=False)[0].float()  # NMS in fp32
+
+
+class ExportedBackend:
+    # Model exported with the Detect() grid, so with a fixed (h, w) input shape and a fixed batch size unless exported
+    # with --dynamic. Smaller inputs are padded bottom-right, which keeps box coordinates, larger batches are split
+    def __init__(self, weights, meta):
+        assert meta.get('grid'), f'{weights} has no Detect() grid, export it with models/export.py --grid'
+        self.weights = weights
+        self.names = meta['names']
+        self.stride = int(meta['stride'])
+        self.shape = tuple(meta['img_size'])
+        self.batch_size = None if meta.get('dynamic') else int(meta['batch_size'])
+        self.nms = meta.get('nms')  # export NMS settings, outputs are zero-padded (bs,max_det,6) detections
+
+    def to(self, dtype):
+        assert dtype == torch.float32, f'{self.name} models are exported in fp32, use precision fp32'
+
+    def __call__(self, img):
+        (bs, _, h, w), (H, W) = img.shape, self.shape
+        assert h <= H and w <= W, f'{self.weights} takes inputs up to {H}x{W}, got {h}x{w}'
+        if (h, w) != (H, W):
+            img = F.pad(img, (0, W - w, 0, H - h), value=114 / 255)  # letterbox grey
+        n = self.batch_size or bs
+        pred = []
+        for i in range(0, bs, n):
+            x = img[i:i + n]
+            if len(x) < n:
+                x = torch.cat((x, x.new_zeros((n - len(x), *x.shape[1:]))), 0)
+            pred.append(self.forward(x)[:bs - i])
+        return torch.cat(pred, 0) if len(pred) > 1 else pred[0]
+
+
+class TorchScriptBackend(ExportedBackend):
+    name = 'torchscript'
+
+    def __init__(self, weights, device='cpu'):
+        extra_files = {'config.txt': ''}  # model metadata, see models/export.py
+        self.model = torch.jit.load(weights, map_location=device, _extra_files=extra_files)
+        assert extra_files['config.txt'], f'{weights} has no metadata, export it again with models/export.py'
+        meta = json.loads(extra_files['config.txt'])
+        if meta.get('nms'):
+            import torchvision  # registers torchvision::nms
+        if meta.get('engine'):  # int8 model of quantize.py
+            torch.backends.quantized.engine = meta['engine']
+        super().__init__(weights, meta)
+
+    def forward(self, x):
+        y = self.model(x.contiguous())
+        return (y if self.nms else y[0]).float()
+
+
+class OnnxBackend(ExportedBackend):
+    name = 'onnx'
+
+    def __init__(self, weights, device='cpu'):
+        import onnxruntime
+
+        self.model = onnxruntime.InferenceSession(weights, providers=['CPUExecutionProvider'])
+        meta = self.model.get_modelmeta().custom_metadata_map
+        assert meta, f'{weights} has no metadata, export it again with models/export.py'
+        super().__init__(weights, {k: json.loads(v) for k, v in meta.items()})
+        self.device = torch.device(device)
+
+    def forward(self, x):
+        return onnx_run(self.model, x, self.device)
+
+
+class OnnxClassifier:
+    # Helmet classifier ONNX export on the onnxruntime CPU provider, called like the torch module
+    def __init__(self, weights, device='cpu'):
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(weights, providers=['CPUExecutionProvider'])
+        self.device = torch.device(device)
+
+    def __call__(self, x):
+        return onnx_run(self.session, x, self.device)
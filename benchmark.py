@@ -0,0 +1,348 @@
+"""Micro-benchmarks for the helmet detection hot path
+
+Usage:
+    $ python benchmark.py association --riders 1 5 20 50
+    $ python benchmark.py precision --precision fp32 bf16 fp16
+    $ python benchmark.py preprocess --heads 1 8 32
+    $ python benchmark.py memory --source clip.mp4 --frames 300
+    $ python benchmark.py backends --weights model.pt model.torchscript.pt model.onnx --img-size 640
+    $ python benchmark.py nms --batch-sizes 1 8 32
+    $ python benchmark.py topk --topk 100 300 1000 --conf-thres 0.01
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+
+def timeit(f, *args, n=100):
+    # Mean wall time of f(*args) in ms over n runs, after one warm-up run
+    f(*args)
+    t = time.perf_counter()
+    for _ in range(n):
+        f(*args)
+    return (time.perf_counter() - t) * 1E3 / n
+
+
+def random_scene(riders=10, seed=0):
+    # Detections [x1, y1, x2, y2, conf, cls] of a street scene with a head and a number plate inside every rider
+    rng = np.random.default_rng(seed)
+    results = []
+    for _ in range(riders):
+        x1, y1 = rng.integers(0, 700), rng.integers(0, 300)
+        w, h = rng.integers(40, 100), rng.integers(100, 180)
+        results.append([x1, y1, x1 + w, y1 + h, round(rng.uniform(0.35, 1), 2), 0])  # rider
+        results.append([x1 + w // 4, y1 + 2, x1 + 3 * w // 4, y1 + h // 4, round(rng.uniform(0.35, 1), 2), 1])  # head
+        results.append([x1 + w // 4, y1 + 3 * h // 4, x1 + 3 * w // 4, y1 + h - 2, round(rng.uniform(0.35, 1), 2), 2])
+    rng.shuffle(results)
+    return [[int(x) for x in r[:4]] + r[4:] for r in results]
+
+
+def association_loops(results):
+    # Rider/head/plate association as main.py did it with nested Python loops over is_bounding_box_inside()
+    from my_functions import is_bounding_box_inside
+
+    pairs = []
+    rider_list, head_list, number_list = [], [], []
+    for result in results:
+        if result[5] == 0:
+            rider_list.append(result)
+        elif result[5] == 1:
+            head_list.append(result)
+        elif result[5] == 2:
+            number_list.append(result)
+
+        for rdr in rider_list:  # rider loop nested in the results loop
+            for hd in head_list:
+                if is_bounding_box_inside(rdr[:4], hd[:4]):
+                    plates = [num for num in number_list if is_bounding_box_inside(rdr[:4], num[:4])]
+                    pairs.append((rdr, hd, plates))
+    return pairs
+
+
+def benchmark_association(riders=(1, 5, 20, 50), n=100):
+    # Compare the nested-loop association with the vectorized my_functions.associate()
+    from my_functions import associate
+
+    print(f"{'riders':>10s}{'detections':>12s}{'loops (ms)':>14s}{'vectorized (ms)':>18s}{'speedup':>10s}")
+    for r in riders:
+        results = random_scene(r)
+        t_loops = timeit(association_loops, results, n=n)
+        t_vec = timeit(associate, results, n=n)
+        print(f'{r:10d}{len(results):12d}{t_loops:14.3f}{t_vec:18.3f}{t_loops / t_vec:9.1f}x')
+
+
+def benchmark_precision(precisions=('fp32', 'bf16', 'fp16'), heads=8, n=20):
+    # Detector and batched head classifier frames/sec at every my_functions.set_precision() mode
+    import my_functions
+
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (*my_functions.frame_size[::-1], 3), dtype=np.uint8)
+    head_imgs = [rng.integers(0, 256, (rng.integers(20, 60), rng.integers(20, 60), 3), dtype=np.uint8)
+                 for _ in range(heads)]
+    print(f'device {my_functions.device}, frame {frame.shape[1]}x{frame.shape[0]}, {heads} heads per frame')
+    print(f"{'precision':>10s}{'detector (ms)':>16s}{'detector FPS':>15s}{'classifier (ms)':>18s}{'total FPS':>12s}")
+    for p in precisions:
+        try:
+            my_functions.set_precision(p)
+        except AssertionError as e:
+            print(f'{p:>10s}  skipped: {e}')
+            continue
+        t_det = timeit(my_functions.object_detection, frame, n=n)
+        t_cls = timeit(my_functions.image_classify_batch, head_imgs, n=n)
+        print(f'{p:>10s}{t_det:16.1f}{1E3 / t_det:15.1f}{t_cls:18.1f}{1E3 / (t_det + t_cls):12.1f}')
+    my_functions.set_precision('fp32')
+
+
+def preprocess_pil(frames):
+    # Head crops to classifier inputs as image_classify() did, PIL round trip and torchvision transform per crop
+    from PIL import Image
+    from my_functions import transform
+
+    return [transform(Image.fromarray(f)).unsqueeze(0) for f in frames]
+
+
+def preprocess_letterbox(frames):
+    # Head crops to one classifier batch as image_classify_batch() did, letterbox() and np.stack() allocations per call
+    import torch
+    from my_functions import head_size
+    from utils.datasets import letterbox
+
+    batch = np.stack([letterbox(f, head_size, auto=False)[0] for f in frames], 0)
+    return torch.from_numpy(batch).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+
+
+def benchmark_preprocess(heads=(1, 8, 32), n=100):
+    # Compare the PIL transform, the letterbox + stack batch and the preallocated HelmetClassifier.preprocess()
+    from my_functions import HelmetClassifier
+
+    classifier = HelmetClassifier(device='cpu')
+    rng = np.random.default_rng(0)
+    print(f"{'heads':>10s}{'PIL (ms)':>12s}{'letterbox (ms)':>17s}{'buffer (ms)':>14s}{'speedup':>10s}")
+    for h in heads:
+        frames = [rng.integers(0, 256, (rng.integers(20, 80), rng.integers(20, 80), 3), dtype=np.uint8)
+                  for _ in range(h)]
+        t_pil = timeit(preprocess_pil, frames, n=n)
+        t_lb = timeit(preprocess_letterbox, frames, n=n)
+        t_buf = timeit(classifier.preprocess, frames, n=n)
+        print(f'{h:10d}{t_pil:12.3f}{t_lb:17.3f}{t_buf:14.3f}{t_pil / t_buf:9.1f}x')
+
+
+def autograd_detection(frame):
+    # object_detection() as it ran before inference mode, the forward records an autograd graph per frame
+    import my_functions
+    from utils.general import non_max_suppression
+
+    detector = my_functions.detector
+    pred = detector.model(detector.letterbox(frame, detector.img_size), augment=False)[0].float()
+    return non_max_suppression(pred, detector.conf_thres, detector.iou_thres)[0].detach().cpu().numpy()
+
+
+def check_inference_mode(frame, heads=8):
+    # Run the detector and the batched head classifier once with forward hooks on their torch modules, raises
+    # AssertionError if a runtime forward ran with autograd enabled or returned a tensor that requires grad
+    import torch
+    import my_functions
+
+    failures = []
+
+    def tensors(x):
+        if isinstance(x, torch.Tensor):
+            return [x]
+        return [t for y in x for t in tensors(y)] if isinstance(x, (list, tuple)) else []
+
+    def hook(module, inputs, output):
+        if torch.is_grad_enabled() or any(y.requires_grad or y.grad_fn is not None for y in tensors(output)):
+            failures.append(type(module).__name__)
+
+    modules = [m.model for m in (my_functions.detector, my_functions.classifier) if m.backend_type == 'torch']
+    handles = [m.register_forward_hook(hook) for m in modules]
+    try:
+        my_functions.object_detection(frame)
+        my_functions.image_classify_batch([frame[:64, :64]] * heads)
+    finally:
+        for h in handles:
+            h.remove()
+    assert not failures, f'forward outside inference mode: {", ".join(sorted(set(failures)))}'
+
+
+def clip_run(source, frames, autograd=False, warmup=20):
+    # Detect on the first frames of a recorded clip, returns the per-frame latency (ms) and process RSS (MB) after the
+    # warmup frames. Runs in a fresh process per mode, see benchmark_memory(). Inference mode first checks that no
+    # runtime forward records autograd, see check_inference_mode()
+    import cv2
+    import psutil
+    import my_functions
+
+    if autograd:
+        my_functions.detector.model.requires_grad_(True)
+    detect = autograd_detection if autograd else my_functions.object_detection
+    process = psutil.Process()
+    cap = cv2.VideoCapture(source)
+    latency, rss = [], []
+    for i in range(frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if i == 0 and not autograd:
+            check_inference_mode(frame)
+        t = time.perf_counter()
+        detect(frame)
+        if i >= warmup:
+            latency.append((time.perf_counter() - t) * 1E3)
+            rss.append(process.memory_info().rss / 2 ** 20)
+    cap.release()
+    return latency, rss
+
+
+def benchmark_memory(source, frames=300, tolerance=0.05):
+    # Steady-state RSS and latency of the detector on a recorded clip, inference mode vs. the former autograd forward.
+    # Every mode runs in its own process so the RSS of one does not carry over into the other. Raises AssertionError
+    # if a runtime forward records autograd, or if the inference mode mean RSS or latency exceeds the autograd
+    # baseline by more than tolerance
+    import multiprocessing
+
+    print(f"{'mode':>12s}{'frames':>8s}{'latency (ms)':>14s}{'p95 (ms)':>10s}{'RSS (MB)':>10s}{'RSS max (MB)':>14s}")
+    results = {}
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for mode, autograd in ('autograd', True), ('inference', False):
+            latency, rss = pool.apply(clip_run, (source, frames, autograd))
+            if not latency:
+                print(f'{mode:>12s}  no frames after warm-up, use a longer clip')
+                continue
+            results[mode] = np.mean(latency), np.mean(rss)
+            print(f'{mode:>12s}{len(latency):8d}{np.mean(latency):14.1f}{np.percentile(latency, 95):10.1f}'
+                  f'{np.mean(rss):10.1f}{max(rss):14.1f}')
+    if len(results) == 2:
+        for k, name in enumerate(('latency', 'RSS')):
+            a, b = results['inference'][k], results['autograd'][k]
+            assert a <= b * (1 + tolerance), f'inference mode {name} {a:.1f} above the autograd baseline {b:.1f}'
+        print('inference mode latency and RSS within the autograd baseline')
+
+
+def benchmark_backends(weights, img_size=640, source=None, frames=10, conf_thres=None, n=20):
+    # Latency (forward and NMS) of every detector backend on the same fixed img_size input, and the largest box
+    # difference after NMS to the first weights. Exported models need the same --img-size as the benchmark
+    import cv2
+    from my_functions import Detector
+
+    if source:
+        cap = cv2.VideoCapture(source)
+        images = [cap.read()[1] for _ in range(frames)]
+        cap.release()
+        images = [x for x in images if x is not None]
+    else:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, (480, 800, 3), dtype=np.uint8) for _ in range(frames)]
+    print(f'{len(images)} frames at {img_size}x{img_size}')
+    print(f"{'backend':>12s}{'latency (ms)':>14s}{'FPS':>8s}{'boxes':>8s}{'max box diff (px)':>20s}  weights")
+    reference = None
+    for w in weights:
+        detector = Detector(w, device='cpu', img_size=img_size)
+        if conf_thres is not None:
+            detector.conf_thres = conf_thres
+        backend = detector.backend
+        img = detector.letterbox(images[0], img_size, auto=False)  # same input shape for every backend
+        t = timeit(lambda x: detector.nms(backend(x)), img, n=n)  # forward and NMS
+        dets = [detector.nms(backend(detector.letterbox(x, img_size, auto=False)))[0] for x in images]
+        if reference is None:
+            reference, diff = dets, 'reference'
+        elif any(len(a) != len(b) for a, b in zip(dets, reference)):
+            diff = 'box count differs'
+        else:
+            # distance of every box to the closest reference box, NMS may order near-equal confidences differently
+            diff = max([(a[:, None, :4] - b[None, :, :4]).abs().amax(2).amin(1).max().item()
+                        for a, b in zip(dets, reference) if len(a)] or [0])
+            diff = f'{diff:.4f}'
+        print(f'{backend.name:>12s}{t:14.1f}{1E3 / t:8.1f}{sum(len(d) for d in dets):8d}{diff:>20s}  {w}')
+
+
+def random_predictions(bs, n=25200, nc=3, objects=20, seed=0):
+    # Raw (bs,n,5+nc) predictions of a 640x640 batch as non_max_suppression() takes them: a cluster of overlapping
+    # confident boxes around every object and a low confidence background
+    import torch
+
+    g = torch.Generator().manual_seed(seed)
+    pred = torch.rand(bs, n, 5 + nc, generator=g)
+    pred[..., :2] *= 640  # xy
+    pred[..., 2:4] = pred[..., 2:4] * 60 + 5  # wh
+    pred[..., 4] = pred[..., 4] ** 6 * 0.3  # objectness
+    for x in pred:
+        for _ in range(objects):
+            i = torch.randint(0, n, (60,), generator=g)
+            box = torch.rand(4, generator=g) * torch.tensor([640, 640, 100, 100]) + torch.tensor([0, 0, 10, 10])
+            x[i, :4] = box + torch.randn(60, 4, generator=g) * 3
+            x[i, 4] = torch.rand(60, generator=g) * 0.5 + 0.5
+    return pred
+
+
+def benchmark_nms(batch_sizes=(1, 8, 32), conf_thres=0.25, iou_thres=0.45, n=20):
+    # Compare the per-image loop of non_max_suppression() with non_max_suppression_batched(), outputs must be identical
+    import torch
+    from utils.general import non_max_suppression, non_max_suppression_batched
+
+    print(f'conf {conf_thres}, iou {iou_thres}')
+    print(f"{'batch':>10s}{'candidates':>12s}{'loop (ms)':>12s}{'batched (ms)':>15s}{'speedup':>10s}  identical")
+    for bs in batch_sizes:
+        pred = random_predictions(bs)
+        t_loop = timeit(lambda x: non_max_suppression(x, conf_thres, iou_thres), pred, n=n)
+        t_batched = timeit(lambda x: non_max_suppression_batched(x, conf_thres, iou_thres), pred, n=n)
+        a = non_max_suppression(pred, conf_thres, iou_thres)
+        b = non_max_suppression_batched(pred, conf_thres, iou_thres)
+        same = len(a) == len(b) and all(x.shape == y.shape and torch.equal(x, y) for x, y in zip(a, b))
+        print(f'{bs:10d}{int((pred[..., 4] > conf_thres).sum()):12d}{t_loop:12.2f}{t_batched:15.2f}'
+              f'{t_loop / t_batched:9.2f}x  {same}')
+
+
+def benchmark_topk(topks=(100, 300, 1000), conf_thres=0.01, iou_thres=0.45, objects=100, n=20):
+    # non_max_suppression() latency and candidate counts of a crowded frame at every pre-NMS top-k limit, and the
+    # fraction of the detections without top-k that are kept
+    from utils.general import non_max_suppression
+
+    pred = random_predictions(1, objects=objects)
+    reference = non_max_suppression(pred, conf_thres, iou_thres)[0]
+    print(f'conf {conf_thres}, iou {iou_thres}, {objects} objects')
+    print(f"{'topk':>10s}{'candidates':>12s}{'after topk':>12s}{'into NMS':>10s}{'detections':>12s}"
+          f"{'latency (ms)':>14s}{'kept':>8s}")
+    for topk in (None, *topks):
+        stats = {}
+        det = non_max_suppression(pred, conf_thres, iou_thres, topk=topk, stats=stats)[0]
+        t = timeit(lambda x: non_max_suppression(x, conf_thres, iou_thres, topk=topk), pred, n=n)
+        kept = (det[:, None] == reference[None]).all(2).any(0).float().mean().item() if len(reference) else 1.0
+        print(f"{str(topk or 'none'):>10s}{stats['candidates']:12d}{stats['topk']:12d}{stats['nms']:10d}"
+              f"{stats['detections']:12d}{t:14.2f}{kept * 100:7.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark',
+                        choices=['association', 'precision', 'preprocess', 'memory', 'backends', 'nms', 'topk'],
+                        help='benchmark to run')
+    parser.add_argument('--riders', nargs='+', type=int, default=[1, 5, 20, 50], help='riders per frame')
+    parser.add_argument('--heads', nargs='+', type=int, default=[1, 8, 32], help='head crops per frame')
+    parser.add_argument('--precision', nargs='+', default=['fp32', 'bf16', 'fp16'], help='inference precisions')
+    parser.add_argument('--source', type=str, help='recorded clip for the memory benchmark')
+    parser.add_argument('--frames', type=int, default=300, help='clip frames analysed by the memory benchmark')
+    parser.add_argument('--weights', nargs='+', help='detector weights of every backend, .pt first as the reference')
+    parser.add_argument('--img-size', type=int, default=640, help='detector input size of the backends benchmark')
+    parser.add_argument('--conf-thres', type=float, help='confidence threshold of the NMS benchmarks')
+    parser.add_argument('--topk', nargs='+', type=int, default=[100, 300, 1000], help='topk benchmark pre-NMS limits')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32], help='nms benchmark batch sizes')
+    parser.add_argument('--n', type=int, default=100, help='timed runs per measurement')
+    opt = parser.parse_args()
+
+    if opt.benchmark == 'association':
+        benchmark_association(opt.riders, opt.n)
+    elif opt.benchmark == 'precision':
+        benchmark_precision(opt.precision, n=opt.n)
+    elif opt.benchmark == 'preprocess':
+        benchmark_preprocess(opt.heads, opt.n)
+    elif opt.benchmark == 'memory':
+        benchmark_memory(opt.source, opt.frames)
+    elif opt.benchmark == 'backends':
+        benchmark_backends(opt.weights, opt.img_size, opt.source, opt.frames, opt.conf_thres, opt.n)
+    elif opt.benchmark == 'nms':
+        benchmark_nms(opt.batch_sizes, 0.25 if opt.conf_thres is None else opt.conf_thres, n=opt.n)
+    elif opt.benchmark == 'topk':
+        benchmark_topk(opt.topk, 0.01 if opt.conf_thres is None else opt.conf_thres, n=opt.n)
@@ -1,9 +1,19 @@
 # this file name is main.py
 import os
 import cv2
+import numpy as np
 import time
 import argparse
-from my_functions import is_bounding_box_inside, image_classify, object_detection
+import queue
+import signal
+import my_functions
+from my_functions import associate, image_classify_batch, object_detection, object_detection_batch, draw_detections, \
+    configure
+from pipeline import CropWriter, FrameQueue, RateLimiter, StageStats, pipeline_report
+from motion import MotionGate
+from roi import load_rois
+from tracker import Tracker
+from utils.datasets import LoadStreams
 import pygame
 import threading
 
@@ -19,7 +29,142 @@ import threading
 #     while pygame.mixer.music.get_busy():
 #         pygame.time.Clock().tick(10)
 
-def main(ip_address):
+def camera_source(ip_or_url):
+    # Video URL of the IP Webcam app for a bare IP address, URLs and webcam indices are passed through
+    return ip_or_url if '://' in ip_or_url or ip_or_url.isnumeric() else f'http://{ip_or_url}:8080/video'
+
+
+def analyse_frame(frame, tracker, verbose=False, mask=None, roi=None):
+    # Detect riders, heads and number plates and classify helmets, returns the (n,6) detections, the classified heads
+    # [(head, helmet_present)] and the finished violation tracks. Nothing is drawn, the output stage draws only the
+    # frames it shows or records. mask is the motion mask, in tile mode tiles without motion are not run. With a
+    # camera roi only the ROI is analysed
+    if roi is None:
+        _, det = object_detection(frame, verbose=verbose, mask=mask)  # det = (n,6) [xyxy, conf, cls]
+    else:
+        det = roi_detection(frame, roi, verbose, mask)
+    heads, violations = analyse_detections(frame, det, tracker)
+    return det, heads, violations
+
+
+def roi_detection(frame, roi, verbose=False, mask=None):
+    # Detect on the ROI bounding rectangle only, returns the (n,6) detections in frame coordinates whose box centre
+    # lies inside the ROI polygon
+    crop, (x, y) = roi.crop(frame)
+    _, det = object_detection(crop, verbose=verbose, mask=roi.crop(mask)[0] if mask is not None else None)
+    det[:, :4] += [x, y, x, y]
+    return det[roi.contains(det, frame.shape)]
+
+
+def analyse_detections(original_frame, det, tracker):
+    # Track riders, associate heads and number plates with them and classify helmets, det is the (n,6) detections
+    # array. Returns the classified heads [(head, helmet_present)] and the violation tracks finished this frame
+    tracks = tracker.update(det[det[:, 5] == 0])  # rider tracks, in the rider order of associate()
+    riders, rider_heads, rider_plates = associate(det)
+
+    # Classify heads with one batched forward, only for riders whose track has not cached its helmet vote yet
+    todo = [i for i, h in enumerate(rider_heads) if h >= 0 and not tracks[i].decided]
+    head_imgs = [original_frame[y1h:y2h, x1h:x2h]
+                 for x1h, y1h, x2h, y2h in det[rider_heads[todo], :4].astype(int).tolist()]
+    for i, helmet_present in zip(todo, image_classify_batch(head_imgs)):
+        tracks[i].vote(helmet_present)
+
+    heads = []
+    for track, r, h, p in zip(tracks, riders, rider_heads, rider_plates):
+        if h < 0 or track.helmet_present is None:  # rider without classified head
+            continue
+        heads.append((det[h], track.helmet_present))
+        if track.helmet_present[0] == False:  # if helmet absent, keep the track's best rider and plate crop
+            track.keep_best(original_frame, det[r], det[p] if p >= 0 else None)
+
+    violations = [t for t in tracker.pop_finished() if t.is_violation]
+    return heads, violations
+
+
+def skip_frame(frame, tracker, idle):
+    # Frame skipped by the motion gate: nothing new to draw, but an idle scene still ages the rider tracks so that
+    # riders who left are finished and saved
+    if idle:
+        tracker.update(np.zeros((0, 6), dtype=np.float32))
+    return frame, [], [t for t in tracker.pop_finished() if t.is_violation]
+
+
+def annotate_frame(frame, heads):
+    # Draw helmet classification results on the frame
+    for hd, helmet_present in heads:
+        x1h, y1h, x2h, y2h = hd[:4].astype(int).tolist()
+        if helmet_present[0] == True:  # if helmet present
+            frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 255, 0), 1)
+            frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
+        elif helmet_present[0] == None:  # If poor prediction, draw yellow rectangle and display uncertainty message
+            frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 255, 255), 1)
+            uncertainty_message = "Uncertain"
+            frame = cv2.putText(frame, uncertainty_message, (x1h, y1h + 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                                (0, 0, 255), 1, cv2.LINE_AA)
+            frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
+        elif helmet_present[0] == False:  # if helmet absent
+            frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 0, 255), 1)
+            frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
+    return frame
+
+
+def save_violations(violations, writer, current_datetime):
+    # Queue the best rider and number plate crop of each finished violation track on the background crop writer
+    for track in violations:
+        rider_img, num_img, conf_num = track.crops
+        writer.put('riders_pictures', f'{current_datetime}_{track.id}', rider_img)
+        if num_img is not None:
+            writer.put('number_plates', f'{current_datetime}_{track.id}_{conf_num:.2f}', num_img)
+
+
+def capture_stage(cap, frames, stats, stop):
+    # Capture thread: read camera frames into the frames queue until the stream ends or stop is set. The queue is
+    # closed even if reading raises, so the next stage never waits forever
+    try:
+        while cap.isOpened() and not stop.is_set():
+            t = time.time()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            stats.update(time.time() - t)
+            frames.put((t, frame))  # (capture time, frame)
+    finally:
+        frames.close()
+
+
+def inference_stage(frames, outputs, stats, stop, tracker, writer, stem, gate=None, roi=None, verbose=False):
+    # Inference thread: detect and classify queued frames and pass the frame and results on to the output stage.
+    # Frames the motion gate rejects skip detection and are passed on without detections (None). Finished violations
+    # are queued on the crop writer here, the outputs queue may drop frames but never violations. The outputs queue is
+    # closed even if inference raises (i.e. missing weights), which ends the output loop
+    try:
+        while not stop.is_set():
+            item = frames.get()
+            if item is None:  # end of stream
+                break
+            t0, frame = item
+            if gate is not None and not gate(frame, t0):
+                det = None
+                frame, heads, violations = skip_frame(frame, tracker, gate.idle)
+            else:
+                t = time.time()
+                det, heads, violations = analyse_frame(frame, tracker, verbose,
+                                                       gate.mask if gate is not None else None, roi)
+                dt = time.time() - t
+                stats.update(dt)
+                if gate is not None:
+                    gate.update_time(dt)
+            save_violations(violations, writer, stem)
+            outputs.put((t0, frame, det, heads))
+    finally:
+        outputs.close()
+
+
+def main(ip_address, queue_size=2, drop_policy='drop-oldest', report_interval=5.0, motion_gate=True,
+         roi_file='roi.ini', headless=False, preview_fps=0.0, save=True, verbose=False):
     global main_process_pid  # Declare main_process_pid as global
     # Create the output folder if it doesn't exist
     output_folder = 'output_folder'  # Specify the output folder name
@@ -27,103 +172,234 @@ def main(ip_address):
         os.makedirs(output_folder)
 
     # Set up video capture and output
-    source = f'http://{ip_address}:8080/video'  # Use the provided IP address in the source URL
+    source = camera_source(ip_address)  # Use the provided IP address in the source URL
     cap = cv2.VideoCapture(source)
-    frame_size = (800, 480)
     fourcc = cv2.VideoWriter_fourcc(*'XVID')
-    current_datetime = time.strftime("%Y%m%d_%H%M%S")  # Get the current date and time stamp
+    # Current date and time stamp and process id, unique across the processes interface.py starts per camera
+    current_datetime = f'{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}'
     output_video_path = os.path.join(output_folder, f'output_video/output_{current_datetime}.avi')  # Specify the output video path
-    out = cv2.VideoWriter(output_video_path, fourcc, 20.0, frame_size)
-
-    # Main loop
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if ret == True:
-            frame = cv2.resize(frame, frame_size)
-            original_frame = frame.copy()
-            # Assuming object_detection function returns the processed frame and results
-            frame, results = object_detection(frame)
-
-            rider_list = []
-            head_list = []
-            number_list = []
-
-            for result in results:
-                x1, y1, x2, y2, conf, clas = result
-                if clas == 0:
-                    rider_list.append(result)
-                elif clas == 1:
-                    head_list.append(result)
-                elif clas == 2:
-                    number_list.append(result)
-
-                for rdr in rider_list:
-                    time_stamp = str(time.time())
-                    x1r, y1r, x2r, y2r, cnfr, clasr = rdr
-                    for hd in head_list:
-                        x1h, y1h, x2h, y2h, cnfh, clash = hd
-                        if is_bounding_box_inside([x1r, y1r, x2r, y2r], [x1h, y1h, x2h, y2h]):
-                            try:
-                                head_img = original_frame[y1h:y2h, x1h:x2h]
-                                helmet_present = image_classify(head_img)
-                            except:
-                                helmet_present[0] = None
-
-                            if helmet_present[0] == True:  # if helmet present
-                                frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 255, 0), 1)
-                                frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
-                                                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
-                            elif helmet_present[0] == None:  # If poor prediction, draw yellow rectangle and display uncertainty message
-                                frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 255, 255), 1)
-                                uncertainty_message = "Uncertain"
-                                frame = cv2.putText(frame, uncertainty_message, (x1h, y1h + 60), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-                                                    (0, 0, 255), 1, cv2.LINE_AA)
-                                frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
-                                                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
-                            elif helmet_present[0] == False:  # if helmet absent
-                                frame = cv2.rectangle(frame, (x1h, y1h), (x2h, y2h), (0, 0, 255), 1)
-                                frame = cv2.putText(frame, f'{round(helmet_present[1], 1)}', (x1h, y1h + 40),
-                                                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
-                                try:
-                                    cv2.imwrite(os.path.join(output_folder, f'riders_pictures/{time_stamp}.jpg'),
-                                            original_frame[y1r:y2r, x1r:x2r])
-                                    print('Rider saved')
-                                except:
-                                    print('could not save rider')
-
-                                for num in number_list:
-                                    x1_num, y1_num, x2_num, y2_num, conf_num, clas_num = num
-                                    if is_bounding_box_inside([x1r, y1r, x2r, y2r], [x1_num, y1_num, x2_num, y2_num]):
-                                        try:
-                                            num_img = original_frame[y1_num:y2_num, x1_num:x2_num]
-                                            cv2.imwrite(os.path.join(output_folder, f'number_plates/{current_datetime}_{conf_num}.jpg'),
-                                                        num_img)
-                                            print("Number plate saved successfully")
-                                        except:
-                                            print('could not save number plate')
+    out = None  # opened at the camera frame size on the first frame
+
+    # Pipeline: capture thread -> frames queue -> inference thread -> outputs queue -> output stage (this thread)
+    frames = FrameQueue(queue_size, drop_policy)
+    outputs = FrameQueue(queue_size, drop_policy)
+    stats = [StageStats(x) for x in ('capture', 'inference', 'output', 'end-to-end')]
+    stop = threading.Event()
+    tracker = Tracker()
+    writer = CropWriter(output_folder)
+    gate = MotionGate(fps=cap.get(cv2.CAP_PROP_FPS) % 100 or 20.0) if motion_gate else None
+    rois = load_rois(roi_file)
+    roi = rois.get(ip_address, rois.get(source))  # camera region of interest
+    threads = [threading.Thread(target=capture_stage, args=(cap, frames, stats[0], stop), daemon=True),
+               threading.Thread(target=inference_stage,
+                                args=(frames, outputs, stats[1], stop, tracker, writer, current_datetime, gate, roi,
+                                      verbose), daemon=True)]
+    for thread in threads:
+        thread.start()
+    # Preview every frame, or at most preview_fps frames per second, headless runs show none unless preview_fps is set
+    preview = RateLimiter(preview_fps) if not headless or preview_fps > 0 else None
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # terminate (i.e. from interface.py) stops like Ctrl+C
+
+    # Output loop
+    t_report = time.time()
+    try:
+        while True:
+            try:
+                item = outputs.get(timeout=1.0)
+            except queue.Empty:
+                if not threads[1].is_alive():  # inference thread died without closing the queue
+                    print('Inference stage stopped')
+                    break
+                continue
+            if item is None:  # end of stream
+                break
+            t0, frame, det, heads = item
+            t = time.time()
+            show = preview is not None and preview.ready()
+            if show or save:
+                if det is not None:
+                    frame = draw_detections(frame, det)
+                    if roi is not None:
+                        frame = roi.draw(frame)
+                frame = annotate_frame(frame, heads)
 
             # Display the processed frame
-            cv2.imshow('Frame', frame)
+            if show:
+                cv2.imshow('Frame', frame)
 
             # Write to video file
-            out.write(frame)
+            if save:
+                if out is None:
+                    out = cv2.VideoWriter(output_video_path, fourcc, 20.0, (frame.shape[1], frame.shape[0]))
+                out.write(frame)
+            stats[2].update(time.time() - t)
+            stats[3].update(time.time() - t0)
 
-            # Break the loop if 'q' is pressed
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+            if report_interval and time.time() - t_report > report_interval:
+                detector = my_functions.detector
+                print(pipeline_report(stats + [writer, detector.buffers, detector.candidates] +
+                                      ([gate] if gate else []), {'frames': frames, 'outputs': outputs}))
+                t_report = time.time()
 
-        else:
-            break
+            # Break the loop if 'q' is pressed in the preview window
+            if show and cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    except KeyboardInterrupt:
+        print('Interrupted')
 
-    # Release the capture and close all windows
+    # Stop the worker threads, release the capture and close all windows
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=5.0)
+    save_violations([t for t in tracker.flush() if t.is_violation], writer, current_datetime)
+    writer.close()
+    print(writer.summary())
     cap.release()
-    out.release()
-    cv2.destroyAllWindows()
+    if out is not None:
+        out.release()
+    if preview is not None:
+        cv2.destroyAllWindows()
     print('Execution completed')
 
+
+def main_streams(sources, motion_gate=True, roi_file='roi.ini', headless=False, preview_fps=0.0, save=True,
+                 verbose=False):
+    # Serve several cameras from one process and one set of weights. Every tick the latest frame of each stream is
+    # letterboxed into one batch for a single detector forward, riders are then analysed per stream. Streams without a
+    # new frame since the last tick are skipped, a frame is analysed (and votes for helmets) once. The batch needs
+    # whole frames, so a stream's ROI only drops the boxes outside its polygon
+    output_folder = 'output_folder'  # Specify the output folder name
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    if len(sources) == 1 and os.path.isfile(sources[0]):  # streams.txt with one camera per line
+        with open(sources[0]) as f:
+            sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip())]
+
+    detector = my_functions.detector
+    stride = detector.stride  # loads the weights and checks detector.img_size
+    if detector.tile or detector.cascade:
+        print('WARNING: tile and cascade modes are not supported with --sources, every stream is detected on the whole '
+              'letterboxed frame')
+    preview = RateLimiter(preview_fps) if not headless or preview_fps > 0 else None
+    dataset = LoadStreams([camera_source(s) for s in sources], img_size=detector.img_size, stride=stride,
+                          view=preview is not None)
+    fourcc = cv2.VideoWriter_fourcc(*'XVID')
+    # Current date and time stamp and process id, unique across the processes interface.py starts per camera
+    current_datetime = f'{time.strftime("%Y%m%d_%H%M%S")}_{os.getpid()}'
+    outs = {}  # video writers per stream
+    trackers = [Tracker() for _ in dataset.sources]  # rider tracks per stream
+    gates = [MotionGate(fps=fps) for fps in dataset.stored_fps] if motion_gate else None  # gates see stored frames
+    rois = load_rois(roi_file)
+    rois = [rois.get(s, rois.get(camera_source(s))) for s in sources]  # camera regions of interest
+    writer = CropWriter(output_folder)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # terminate stops like Ctrl+C
+    frame_ids = [-1] * len(sources)  # frame number of every stream at the last tick, see LoadStreams.frames
+
+    try:
+        for paths, img, im0s, _ in dataset:  # also stops when 'q' is pressed in a preview window
+            # LoadStreams returns once a stream has a new frame and stops once every stream reader has stopped
+            new = [i for i, (a, b) in enumerate(zip(dataset.frame_ids, frame_ids)) if a != b]  # streams with new frames
+            frame_ids = dataset.frame_ids
+
+            # Batch only the new frames the motion gates let through
+            active = [i for i in new if gates is None or gates[i](im0s[i])]
+            dets = {}
+            if active:
+                t = time.time()
+                dets = dict(zip(active, object_detection_batch(img[active], [im0s[i] for i in active], verbose)))
+                for i in active if gates else []:
+                    gates[i].update_time(time.time() - t)  # per tick, the forward is shared
+
+            show = preview is not None and preview.ready()  # one preview tick for all streams
+            for i in new:
+                path, im0 = paths[i], im0s[i]
+                if i in dets:
+                    if rois[i] is not None:
+                        dets[i] = dets[i][rois[i].contains(dets[i], im0.shape)]
+                    heads, violations = analyse_detections(im0, dets[i], trackers[i])
+                else:
+                    _, heads, violations = skip_frame(im0, trackers[i], gates[i].idle)
+                save_violations(violations, writer, f'{current_datetime}_{i}')
+                if not (show or save):
+                    continue
+
+                # Draw, display and write the processed frame of this stream
+                frame = im0.copy()  # im0 may still be the stream's latest frame, copy it
+                if i in dets:
+                    frame = draw_detections(frame, dets[i])
+                    if rois[i] is not None:
+                        frame = rois[i].draw(frame)
+                frame = annotate_frame(frame, heads)
+                if show:
+                    cv2.imshow(path, frame)
+                if save:
+                    if i not in outs:
+                        output_video_path = os.path.join(output_folder,
+                                                         f'output_video/output_{current_datetime}_{i}.avi')
+                        outs[i] = cv2.VideoWriter(output_video_path, fourcc, dataset.stored_fps[i],
+                                                  (frame.shape[1], frame.shape[0]))  # real-time playback
+                    outs[i].write(frame)
+    except KeyboardInterrupt:
+        print('Interrupted')
+
+    for i, tracker in enumerate(trackers):
+        save_violations([t for t in tracker.flush() if t.is_violation], writer, f'{current_datetime}_{i}')
+    writer.close()
+    print(writer.summary())
+    for out in outs.values():
+        out.release()
+    if preview is not None:
+        cv2.destroyAllWindows()
+    print('Execution completed')
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--ip", type=str, default="192.168.1.102", help="Camera IP address")
+    parser.add_argument("--queue-size", type=int, default=2, help="Frames buffered between pipeline stages")
+    parser.add_argument("--drop-policy", type=str, default="drop-oldest", choices=["drop-oldest", "drop-newest"],
+                        help="Frame to drop when a pipeline queue is full")
+    parser.add_argument("--sources", nargs="+", type=str,
+                        help="Several camera IPs/URLs or a streams.txt, all served by one process")
+    parser.add_argument("--img-size", type=int,
+                        help="Detector input size, i.e. 320, 416 or 640, overrides the config file")
+    parser.add_argument("--tile", action="store_true", default=None,
+                        help="Sliced inference on overlapping full resolution tiles, for high resolution cameras, "
+                             "not with --sources")
+    parser.add_argument("--cascade", action="store_true", default=None,
+                        help="Low resolution rider pass, then heads and number plates on upscaled rider crops, "
+                             "not with --sources")
+    parser.add_argument("--roi-file", type=str, default="roi.ini", help="Per-camera region of interest polygons")
+    parser.add_argument("--report-interval", type=float, default=5.0,
+                        help="Seconds between pipeline reports, 0 to disable")
+    parser.add_argument("--no-motion-gate", action="store_true",
+                        help="Run the detector on every frame, even without motion")
+    parser.add_argument("--config", type=str, default="config.ini", help="Config file with a [models] section")
+    parser.add_argument("--weights", type=str, help="Detector weights, overrides the config file")
+    parser.add_argument("--backend", type=str, choices=["auto", "torch", "torchscript", "onnx"],
+                        help="Detector backend, auto picks it from the weights suffix (.pt, .torchscript.pt, .onnx)")
+    parser.add_argument("--classifier-weights", type=str, help="Helmet classifier weights, overrides the config file")
+    parser.add_argument("--int8", action="store_true", default=None,
+                        help="Run the int8 models of quantize.py on CPU")
+    parser.add_argument("--topk", nargs="+", type=int,
+                        help="Pre-NMS candidates kept per class, one limit or one per class, overrides the config file")
+    parser.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"],
+                        help="Inference precision, fp16 needs CUDA, overrides the config file")
+    parser.add_argument("--no-warmup", action="store_true", help="Skip the model warm-up pass at startup")
+    parser.add_argument("--headless", action="store_true",
+                        help="No preview window, i.e. for servers and services without a display")
+    parser.add_argument("--preview-fps", type=float, default=0.0,
+                        help="Rate limit of the preview window, i.e. 2 for a headless spot check, 0 for every frame")
+    parser.add_argument("--nosave", action="store_true", help="Do not record the annotated output video")
+    parser.add_argument("--verbose", action="store_true", help="Print every detection")
     args = parser.parse_args()
+    configure(args.config, warmup=False if args.no_warmup else None, detector=args.weights, backend=args.backend,
+              classifier=args.classifier_weights, precision=args.precision, quantized=args.int8,
+              img_size=args.img_size, tile=args.tile, cascade=args.cascade, topk=args.topk)
     main_process_pid = os.getpid()  # Get the PID of the current process
-    main(args.ip)
+    if args.sources:
+        main_streams(args.sources, not args.no_motion_gate, args.roi_file, args.headless, args.preview_fps,
+                     not args.nosave, args.verbose)
+    else:
+        main(args.ip, args.queue_size, args.drop_policy, args.report_interval, not args.no_motion_gate, args.roi_file,
+             args.headless, args.preview_fps, not args.nosave, args.verbose)
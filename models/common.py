@@ -9,11 +9,13 @@ import pandas as pd
 import requests
 import torch
 import torch.nn as nn
+import torchvision
 from PIL import Image
 from torch.cuda import amp
 
 from utils.datasets import letterbox
-from utils.general import non_max_suppression, make_divisible, scale_coords, increment_path, xyxy2xywh, save_one_box
+from utils.general import non_max_suppression, make_divisible, scale_coords, increment_path, xyxy2xywh, xywh2xyxy, \
+    save_one_box
 from utils.plots import color_list, plot_one_box
 from utils.torch_utils import time_synchronized
 
@@ -223,6 +225,30 @@ class NMS(nn.Module):
         return non_max_suppression(x[0], conf_thres=self.conf, iou_thres=self.iou, classes=self.classes)
 
 
+class FixedNMS(nn.Module):
+    # Traceable Non-Maximum Suppression (NMS) module for exports, same detections as non_max_suppression() (best class
+    # only) in a fixed (bs,max_det,6) [xyxy, conf, cls] output sorted by confidence and zero-padded past the detections
+    conf = 0.25  # confidence threshold
+    iou = 0.45  # IoU threshold
+    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_wh = 4096  # (pixels) maximum box width and height, class offset of the batched NMS
+
+    def __init__(self, max_det=300):
+        super(FixedNMS, self).__init__()
+        self.max_det = max_det  # maximum number of detections per image, the output size
+
+    def forward(self, x):
+        output = []
+        for xi in x[0]:  # image inference, the batch size is fixed when traced
+            conf, j = (xi[:, 5:] * xi[:, 4:5]).max(1)  # conf = obj_conf * cls_conf, best class only
+            i = (conf > self.conf).nonzero().view(-1)
+            i = i[conf[i].argsort(descending=True)[:self.max_nms].sort()[0]]  # in input order, ties as in NMS
+            det = torch.cat((xywh2xyxy(xi[i, :4]), conf[i, None], j[i, None].float()), 1)
+            keep = torchvision.ops.nms(det[:, :4] + det[:, 5:6] * self.max_wh, det[:, 4], self.iou)[:self.max_det]
+            output.append(torch.cat((det[keep], det.new_zeros((self.max_det, 6))), 0)[:self.max_det])
+        return torch.stack(output, 0)
+
+
 class autoShape(nn.Module):
     # input-robust model wrapper for passing cv2/np/PIL/torch inputs. Includes preprocessing, inference and NMS
     conf = 0.25  # NMS confidence threshold
@@ -2,24 +2,159 @@
 
 Usage:
     $ export PYTHONPATH="$PWD" && python models/export.py --weights yolov5s.pt --img 640 --batch 1
+
+Exports with --grid run as detector backends, i.e. config.ini [models] detector = yolov5s.onnx, see backends.py
+
+NMS in the graph, a fixed (batch,max-det,6) [xyxy, conf, cls] output zero-padded past the detections:
+    $ python models/export.py --weights yolov5s.pt --nms --max-det 300 --conf-thres 0.35 --iou-thres 0.30 \
+        --source street.jpg  # parity check of the exported detections on a frame with riders
+
+Helmet classifier (model2) TorchScript and ONNX exports with a dynamic batch axis, checked against the torch module:
+    $ python models/export.py --weights yolov5s.pt --grid --classifier helment_no_helmet.pth
+    $ python models/export.py --weights '' --classifier helment_no_helmet.pth  # classifier only
 """
 
 import argparse
+import json
+import math
+import os
 import sys
 import time
+from pathlib import Path
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
 
+import cv2
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.mobile_optimizer import optimize_for_mobile
 
 import models
+from models.common import FixedNMS
 from models.experimental import attempt_load
 from utils.activations import Hardswish, SiLU
-from utils.general import colorstr, check_img_size, check_requirements, file_size, set_logging
+from utils.datasets import letterbox
+from utils.general import colorstr, check_img_size, check_requirements, file_size, non_max_suppression, set_logging
 from utils.torch_utils import select_device
 
+
+def check_fixed_nms(nms, nc, img_size, batch_size=1, n=3000, atol=1E-4):
+    # Compare FixedNMS with non_max_suppression() on random predictions with many overlapping boxes, on predictions
+    # with tied confidences and duplicate boxes, and on more separate boxes than max_det. Raises AssertionError on a
+    # mismatch, returns the largest difference
+    def compare(m, pred):
+        diff = 0.0
+        for a, b in zip(m((pred,)), non_max_suppression(pred, m.conf, m.iou)):
+            k = min(len(b), m.max_det)
+            assert a.shape == (m.max_det, 6), f'FixedNMS output shape {tuple(a.shape)}'
+            # non_max_suppression() keeps at most 300 detections, FixedNMS may keep more
+            assert not a[k:].any() or len(b) == 300 < m.max_det, f'{int(a[:, 4].gt(0).sum())} detections, not {k}'
+            if k:
+                diff = max(diff, (a[:k] - b[:k]).abs().max().item())
+        assert diff <= atol, f'max difference {diff:.2e}'
+        return diff
+
+    h, w = img_size
+    pred = torch.rand(batch_size, n, 5 + nc)
+    pred[..., :2] *= torch.tensor([w, h])  # xy
+    pred[..., 2:4] = pred[..., 2:4] * 100 + 10  # wh
+    ties = pred.clone()
+    ties[..., 4:] = (ties[..., 4:] * 4).ceil() / 4  # confidences of 4 levels
+    ties[:, n // 2:n // 2 * 2] = ties[:, :n // 2]  # every box twice
+    m = max(nms.max_det, 20) + 50  # more separate boxes than max_det
+    g = math.ceil(m ** 0.5)  # g x g grid, one small box per cell
+    grid = torch.zeros(batch_size, g * g, 5 + nc)
+    yv, xv = torch.meshgrid(torch.arange(g), torch.arange(g))
+    grid[..., 0], grid[..., 1] = (xv.flatten() + 0.5) * w / g, (yv.flatten() + 0.5) * h / g  # cell centres
+    grid[..., 2:4] = min(h, w) / g / 2  # wh, half a cell
+    grid[..., 4], grid[..., 5] = 1.0, 0.5 + 0.5 * torch.rand(batch_size, g * g)  # conf above 0.5, class 0
+
+    small = FixedNMS(max_det=20)  # max_det exceeded without the 300 detections limit of non_max_suppression()
+    small.conf, small.iou = nms.conf, nms.iou
+    return max(compare(nms, pred), compare(nms, ties), compare(nms, grid), compare(small, grid), compare(small, ties))
+
+
+def parity_input(source, img):
+    # Parity input of the NMS exports: the first frame of an image or video source letterboxed to the export shape
+    # for every image of the batch. Uniform noise without a source, which rarely gives detections to compare
+    if not source:
+        return torch.rand_like(img)
+    cap = cv2.VideoCapture(source)
+    ret, frame = cap.read()
+    cap.release()
+    assert ret, f'cannot read {source}'
+    frame = letterbox(frame, img.shape[2:], auto=False)[0]
+    x = torch.from_numpy(np.ascontiguousarray(frame[..., ::-1].transpose(2, 0, 1))).to(img.device)  # BGR to RGB
+    return (x.float() / 255.0)[None].expand_as(img).contiguous()
+
+
+def check_export(f, diff, y, atol=1E-3):
+    # Remove the export f and raise if its detections differ from the torch model detections y by more than atol
+    if diff > atol:
+        os.remove(f)
+        raise AssertionError(f'parity check failed, max difference {diff:.2e}, {f} removed')
+    n = int((y[..., 4] > 0).sum())  # detections compared
+    return f', max difference {diff:.2e} over {n} detections' + \
+        ('' if n else ', WARNING: nothing compared, pass --source with an image of riders')
+
+
+def export_classifier(weights, img_size=144, device='cpu', atol=1E-4):
+    # Export the helmet classifier, a pickled torch module, to TorchScript and ONNX with a dynamic batch axis. Both
+    # exports are compared with the torch module on a batch of another size than the traced one. Each export is written
+    # to a temporary file that only replaces the output once it passes the check, and never overwrites the weights
+    model = torch.load(weights, map_location=device).float().eval()
+    img = torch.zeros(1, 3, img_size, img_size).to(device)
+    x = torch.rand(5, 3, img_size, img_size).to(device) * 2 - 1  # normalized to [-1, 1] as HelmetClassifier inputs
+    with torch.no_grad():
+        y = model(x)
+
+    prefix = colorstr('Classifier TorchScript:')
+    f = Path(weights).with_suffix('.torchscript.pt')  # filename
+    tmp = f.with_name(f.name + '.tmp')
+    try:
+        print(f'\n{prefix} starting export with torch {torch.__version__}...')
+        assert f.resolve() != Path(weights).resolve(), f'export would overwrite the weights {weights}'
+        with torch.no_grad():
+            ts = torch.jit.trace(model, img)
+            ts.save(str(tmp))
+            diff = (torch.jit.load(str(tmp), map_location=device)(x) - y).abs().max().item()
+        assert diff < atol, f'parity check failed, max difference {diff:.2e}'
+        os.replace(tmp, f)
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB), max difference {diff:.2e}')
+    except Exception as e:
+        print(f'{prefix} export failure: {e}')
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    prefix = colorstr('Classifier ONNX:')
+    f = Path(weights).with_suffix('.onnx')  # filename
+    tmp = f.with_name(f.name + '.tmp')
+    try:
+        import onnx
+
+        print(f'{prefix} starting export with onnx {onnx.__version__}...')
+        assert f.resolve() != Path(weights).resolve(), f'export would overwrite the weights {weights}'
+        torch.onnx.export(model, img, str(tmp), verbose=False, opset_version=12, input_names=['images'],
+                          output_names=['output'], dynamic_axes={'images': {0: 'batch'}, 'output': {0: 'batch'}})
+        onnx.checker.check_model(onnx.load(str(tmp)))  # check onnx model
+        try:
+            import onnxruntime
+
+            session = onnxruntime.InferenceSession(str(tmp), providers=['CPUExecutionProvider'])
+            diff = abs(session.run(None, {'images': x.cpu().numpy()})[0] - y.cpu().numpy()).max()
+            assert diff < atol, f'parity check failed, max difference {diff:.2e}'
+            check = f'max difference {diff:.2e}'
+        except ImportError:
+            check = 'parity not checked, pip install onnxruntime'
+        os.replace(tmp, f)
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB), {check}')
+    except Exception as e:
+        print(f'{prefix} export failure: {e}')
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default='./yolov5s.pt', help='weights path')
@@ -29,12 +164,29 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--dynamic', action='store_true', help='dynamic ONNX axes')  # ONNX-only
     parser.add_argument('--simplify', action='store_true', help='simplify ONNX model')  # ONNX-only
+    parser.add_argument('--nms', action='store_true', help='export NMS in the graph, implies --grid')
+    parser.add_argument('--max-det', type=int, default=300, help='detections per image of the --nms output')
+    parser.add_argument('--conf-thres', type=float, default=0.35, help='--nms confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.30, help='--nms IoU threshold')
+    parser.add_argument('--source', type=str, help='--nms parity check image or video, i.e. a street frame')
+    parser.add_argument('--classifier', type=str, help='helmet classifier weights to export as well, i.e. *.pth')
+    parser.add_argument('--classifier-size', type=int, default=144, help='classifier input size')
     opt = parser.parse_args()
     opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
+    opt.grid |= opt.nms  # NMS of the decoded boxes
+    if opt.nms and opt.dynamic:
+        print('--dynamic ignored, the NMS per image loop fixes the batch size')
+        opt.dynamic = False
     print(opt)
     set_logging()
     t = time.time()
 
+    if opt.classifier:
+        export_classifier(opt.classifier, opt.classifier_size, select_device(opt.device))
+    if not opt.weights:  # classifier only
+        print(f'\nExport complete ({time.time() - t:.2f}s).')
+        sys.exit()
+
     # Load PyTorch model
     device = select_device(opt.device)
     model = attempt_load(opt.weights, map_location=device)  # load FP32 model
@@ -58,9 +210,21 @@ if __name__ == '__main__':
         # elif isinstance(m, models.yolo.Detect):
         #     m.forward = m.forward_export  # assign forward (optional)
     model.model[-1].export = not opt.grid  # set Detect() layer grid export
+    if opt.nms:
+        model.nms(max_det=opt.max_det)  # FixedNMS
+        model.model[-1].conf, model.model[-1].iou = opt.conf_thres, opt.iou_thres
     for _ in range(2):
         y = model(img)  # dry runs
+    # Metadata for backends.py. The grid is traced as a constant, so only the batch axis can be dynamic with --grid
+    meta = {'names': labels, 'stride': gs, 'img_size': opt.img_size, 'batch_size': opt.batch_size, 'grid': opt.grid,
+            'dynamic': opt.dynamic,
+            'nms': {'conf': opt.conf_thres, 'iou': opt.iou_thres, 'max_det': opt.max_det} if opt.nms else None}
     print(f"\n{colorstr('PyTorch:')} starting from {opt.weights} ({file_size(opt.weights):.1f} MB)")
+    if opt.nms:
+        diff = check_fixed_nms(model.model[-1], model.model[-2].nc, opt.img_size, opt.batch_size)  # raises on failure
+        print(f"{colorstr('NMS:')} parity check passed, max difference to non_max_suppression() {diff:.2e}")
+        x = parity_input(opt.source, img)  # parity input of the exports
+        y = model(x).detach()
 
     # TorchScript export -----------------------------------------------------------------------------------------------
     prefix = colorstr('TorchScript:')
@@ -69,10 +233,12 @@ if __name__ == '__main__':
         f = opt.weights.replace('.pt', '.torchscript.pt')  # filename
         ts = torch.jit.trace(model, img, strict=False)
         ts = optimize_for_mobile(ts)  # https://pytorch.org/tutorials/recipes/script_optimized.html
-        ts.save(f)
-        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+        ts.save(f, _extra_files={'config.txt': json.dumps(meta)})
+        check = check_export(f, (ts(x) - y).abs().max().item(), y) if opt.nms else ''
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB){check}')
     except Exception as e:
         print(f'{prefix} export failure: {e}')
+        ts = None  # no CoreML export of a failed TorchScript export
 
     # ONNX export ------------------------------------------------------------------------------------------------------
     prefix = colorstr('ONNX:')
@@ -81,13 +247,18 @@ if __name__ == '__main__':
 
         print(f'{prefix} starting export with onnx {onnx.__version__}...')
         f = opt.weights.replace('.pt', '.onnx')  # filename
+        dynamic_axes = {'images': {0: 'batch'}, 'output': {0: 'batch'}} if opt.grid else \
+            {'images': {0: 'batch', 2: 'height', 3: 'width'},  # size(1,3,640,640)
+             'output': {0: 'batch', 2: 'y', 3: 'x'}}
         torch.onnx.export(model, img, f, verbose=False, opset_version=12, input_names=['images'],
-                          dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'},  # size(1,3,640,640)
-                                        'output': {0: 'batch', 2: 'y', 3: 'x'}} if opt.dynamic else None)
+                          output_names=['output'], dynamic_axes=dynamic_axes if opt.dynamic else None)
 
         # Checks
         model_onnx = onnx.load(f)  # load onnx model
         onnx.checker.check_model(model_onnx)  # check onnx model
+        for k, v in meta.items():
+            model_onnx.metadata_props.add(key=k, value=json.dumps(v))
+        onnx.save(model_onnx, f)
         # print(onnx.helper.printable_graph(model_onnx.graph))  # print
 
         # Simplify
@@ -104,7 +275,18 @@ if __name__ == '__main__':
                 onnx.save(model_onnx, f)
             except Exception as e:
                 print(f'{prefix} simplifier failure: {e}')
-        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB)')
+        check = ''
+        if opt.nms:
+            try:
+                import onnxruntime
+
+                session = onnxruntime.InferenceSession(f, providers=['CPUExecutionProvider'])
+                diff = abs(session.run(None, {'images': x.cpu().numpy()})[0] - y.cpu().numpy()).max()
+            except ImportError:
+                check = ', parity not checked, pip install onnxruntime'
+            else:
+                check = check_export(f, diff, y)
+        print(f'{prefix} export success, saved as {f} ({file_size(f):.1f} MB){check}')
     except Exception as e:
         print(f'{prefix} export failure: {e}')
 
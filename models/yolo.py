@@ -174,11 +174,11 @@ class Model(nn.Module):
         self.info()
         return self
 
-    def nms(self, mode=True):  # add or remove NMS module
-        present = type(self.model[-1]) is NMS  # last layer is NMS
+    def nms(self, mode=True, max_det=None):  # add or remove NMS module, FixedNMS(max_det) for exports if max_det
+        present = type(self.model[-1]) in (NMS, FixedNMS)  # last layer is NMS
         if mode and not present:
             logger.info('Adding NMS... ')
-            m = NMS()  # module
+            m = NMS() if max_det is None else FixedNMS(max_det)  # module
             m.f = -1  # from
             m.i = self.model[-1].i + 1  # index
             self.model.add_module(name='%s' % m.i, module=m)  # add
@@ -0,0 +1,76 @@
+# motion.py
+# Motion gate in front of object_detection: background subtraction on a downscaled grey frame skips the detector
+# on empty road, and the time between analysed frames adapts to scene activity and to the measured detection time
+
+import time
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    # Call gate(frame, t) once per frame that reaches it, it returns True when the detector should run on that frame.
+    # Pacing uses the frame times t, not frame counts, since the queues in front of the gate already drop frames
+    def __init__(self, fps=20.0, width=160, pixel_thres=25, min_area=0.002, busy_area=0.02, hold=0.5, max_interval=8,
+                 alpha=0.1):
+        self.fps = fps  # rate of the frames reaching the gate when nothing is dropped
+        self.width = width  # motion analysis width (pixels), height keeps the aspect ratio
+        self.pixel_thres = pixel_thres  # grey level change of a moving pixel
+        self.min_area = min_area  # moving pixel fraction that counts as motion
+        self.busy_area = busy_area  # moving pixel fraction of a busy scene, lighter motion halves the analysis rate
+        self.hold = hold  # seconds to keep analysing after motion stops, i.e. for riders waiting at a light
+        self.max_interval = max_interval  # analyse at least every max_interval / fps seconds while active
+        self.alpha = alpha  # background update rate
+        self.bg = None  # running background (float32)
+        self.mask = None  # motion mask of the last frame at gate resolution, 255 = moving
+        self.activity = 0.0  # moving pixel fraction of the last frame
+        self.idle = True  # no motion within the last hold seconds
+        self.dt = 0.0  # detection time EMA (s)
+        self.motion_time, self.last = None, None  # times of the last frame with motion and the last analysed frame
+        self.seen, self.analysed = 0, 0  # frames in the current report window
+
+    def motion(self, frame):
+        # Update the background model with frame, returns True if enough pixels moved
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.width, max(1, round(h * self.width / w))), interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        if self.bg is None or self.bg.shape != gray.shape:
+            self.bg = gray.astype(np.float32)
+        self.mask = cv2.threshold(cv2.absdiff(gray, cv2.convertScaleAbs(self.bg)), self.pixel_thres, 255,
+                                  cv2.THRESH_BINARY)[1]
+        cv2.accumulateWeighted(gray, self.bg, self.alpha)
+        self.activity = cv2.countNonZero(self.mask) / self.mask.size
+        return self.activity > self.min_area
+
+    @property
+    def period(self):
+        # Seconds between analysed frames: the detection time keeps real-time pace, light activity doubles it
+        p = self.dt * (2 if self.activity < self.busy_area else 1)
+        return min(p, self.max_interval / self.fps)
+
+    def __call__(self, frame, t=None):
+        # t is the frame (capture) time, now by default
+        t = time.time() if t is None else t
+        self.seen += 1
+        if self.motion(frame):
+            self.motion_time = t
+        self.idle = self.motion_time is None or t - self.motion_time > self.hold
+        if self.idle:
+            self.last = None  # analyse the first frame with motion right away
+            return False
+
+        if self.last is not None and t - self.last < self.period - 0.5 / self.fps:  # half a frame of slack
+            return False
+        self.last = t
+        self.analysed += 1
+        return True
+
+    def update_time(self, dt):
+        # Record the time (s) the detector took on an analysed frame
+        self.dt = 0.9 * self.dt + 0.1 * dt if self.dt else dt
+
+    def summary(self):
+        # Return 'analysed/seen frames' for the window and start a new window, i.e. for pipeline_report()
+        s = f'motion gate {self.analysed}/{self.seen} analysed (period {self.period * 1E3:.0f} ms)'
+        self.seen, self.analysed = 0, 0
+        return s
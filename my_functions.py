@@ -1,96 +1,567 @@
-# my_functions.py
-
-import cv2
-import torch
-import torch.backends.cudnn as cudnn
-from models.experimental import attempt_load
-from utils.general import non_max_suppression
-from torchvision import models
-from torchvision import transforms
-from PIL import Image
-import time
-
-yolov5_weight_file = 'C:\\Users\\admin\\Desktop\\Final_Year\\rider_helmet_number_medium.pt' # ... may need full path
-helmet_classifier_weight = 'helment_no_helmet.pth'
-conf_set=0.35
-frame_size=(800, 480) 
-head_classification_threshold= 3.0 # make this value lower if want to detect non helmet more aggresively;
-
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-model = attempt_load(yolov5_weight_file, map_location=device)
-cudnn.benchmark = True 
-names = model.module.names if hasattr(model, 'module') else model.names
-
-# Image classification
-#checkpoint = torch.load(helmet_classifier_weight, map_location=device)
-#model2 = checkpoint['model']  # Adjust key as per your saved checkpoint structure
-#model2.eval()
-model2 = torch.load(helmet_classifier_weight, map_location=device)  # ... may need full path
-model2.eval()
-
-
-transform = transforms.Compose([
-    transforms.Resize(144),
-    # transforms.CenterCrop(142),
-    transforms.ToTensor(),
-    transforms.Normalize([0.5], [0.5])
-])
-
-
-def image_classify(frame):
-    if frame.shape[0] < 5:  # skipping small size heads <----------------  you can adjust this value
-        return [None, 0]
-
-    frame = transform(Image.fromarray(frame))
-    frame = frame.unsqueeze(0)
-    prediction = model2(frame)
-    result_idx = torch.argmax(prediction).item()
-    prediction_conf = sorted(prediction[0])
-
-    cs = (prediction_conf[-1] - prediction_conf[-2]).item()  # confident score
-    if cs > head_classification_threshold:  # < --- Classification confident score. Need to adjust, this value
-        return [True, cs] if result_idx == 0 else [False, cs]
-    else:
-        return [None, cs]
-
-
-def object_detection(frame):
-    img = torch.from_numpy(frame)
-    img = img.permute(2, 0, 1).float().to(device)
-    img /= 255.0
-    if img.ndimension() == 3:
-        img = img.unsqueeze(0)
-
-    pred = model(img, augment=False)[0]
-    pred = non_max_suppression(pred, conf_set, 0.30)  # prediction, conf, iou
-
-    detection_result = []
-    for i, det in enumerate(pred):
-        if len(det):
-            for d in det:  # d = (x1, y1, x2, y2, conf, cls)
-                x1 = int(d[0].item())
-                y1 = int(d[1].item())
-                x2 = int(d[2].item())
-                y2 = int(d[3].item())
-                conf = round(d[4].item(), 2)
-                c = int(d[5].item())
-
-                detected_name = names[c]
-
-                print(f'Detected: {detected_name} conf: {conf}  bbox: x1:{x1}    y1:{y1}    x2:{x2}    y2:{y2}')
-                detection_result.append([x1, y1, x2, y2, conf, c])
-
-                frame = cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 1)  # box
-                if c != 1:  # if it is not a head bbox, then write use putText
-                    frame = cv2.putText(frame, f'{names[c]} {str(conf)}', (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
-                                        (0, 0, 255), 1, cv2.LINE_AA)
-
-    return frame, detection_result
-
-
-def is_bounding_box_inside(big_box, small_box):
-    x1 = small_box[0] - big_box[0]
-    y1 = small_box[1] - big_box[1]
-    x2 = big_box[2] - small_box[2]
-    y2 = big_box[3] - small_box[3]
-    return not bool(min([x1, y1, x2, y2, 0]))
+# my_functions.py
+
+import configparser
+import math
+import cv2
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torchvision
+from backends import backend_type, load_backend, load_classifier
+from pipeline import CandidateStats
+from utils.datasets import letterbox_into, letterbox_shape
+from utils.general import check_img_size, clip_coords, non_max_suppression, non_max_suppression_batched, scale_coords
+from utils.torch_utils import inference_mode
+from torchvision import models
+from torchvision import transforms
+import time
+from pathlib import Path
+
+yolov5_weight_file = 'rider_helmet_number_medium.pt' # ... may need full path, or set detector in config.ini [models]
+helmet_classifier_weight = 'helment_no_helmet.pth'
+conf_set=0.35
+frame_size=(800, 480) 
+head_classification_threshold= 3.0 # make this value lower if want to detect non helmet more aggresively;
+head_size = 144  # batched classifier input size, heads are letterboxed to head_size x head_size
+img_size = 640  # detector input size (pixels), frames are letterboxed to a stride-multiple rectangle within it
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+cudnn.benchmark = True 
+precisions = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+# PIL preprocessing of the classifier training, replaced by HelmetClassifier.preprocess() at inference
+transform = transforms.Compose([
+    transforms.Resize(144),
+    # transforms.CenterCrop(142),
+    transforms.ToTensor(),
+    transforms.Normalize([0.5], [0.5])
+])
+
+
+def check_precision(mode, device):
+    # Return the torch dtype of precision mode ('fp32', 'bf16' or 'fp16') on device, fp16 needs CUDA
+    assert mode in precisions, f'unknown precision {mode}, use one of {list(precisions)}'
+    assert mode != 'fp16' or device.type != 'cpu', 'fp16 inference needs CUDA, use bf16 on CPU'
+    return precisions[mode]
+
+
+def to_input(img, device, dtype, scale=1 / 255.0, shift=0.0, out=None):
+    # uint8 (bs,3,h,w) tensor to a model input in one cast and copy, straight to the inference dtype and channels_last
+    # layout (free for permuted HWC images), then normalized in place to img * scale + shift. The copy goes into the
+    # preallocated tensor out if given
+    x = img.to(device, dtype, memory_format=torch.channels_last) if out is None else out.copy_(img, non_blocking=True)
+    x.mul_(scale)
+    return x.add_(shift) if shift else x
+
+
+class BufferPool:
+    # Preallocated input buffers reused frame after frame, one per image size (h, w): uint8 (bs,h,w,3) host arrays
+    # that letterboxing writes into (pinned on CUDA for async copies) and the channels_last (bs,3,h,w) model inputs
+    # they are cast into. A buffer only grows when a larger batch arrives, smaller batches get [:bs] views of it, so
+    # the varying tile and rider crop batches reuse it too. The counters show the allocations stop once every image
+    # size has been seen at its largest batch. Not thread safe, one pool per detector thread
+    def __init__(self, device, dtype):
+        self.device, self.dtype = device, dtype
+        self.hosts, self.inputs = {}, {}
+        self.allocations, self.requests = 0, 0  # buffers allocated, buffers requested
+
+    def host(self, shape):
+        # uint8 host tensor of shape (bs,h,w,3), write into it through .numpy()
+        self.requests += 1
+        bs, key = shape[0], tuple(shape[1:])
+        if key not in self.hosts or len(self.hosts[key]) < bs:
+            self.allocations += 1
+            self.hosts[key] = torch.zeros((bs, *key), dtype=torch.uint8, pin_memory=self.device.type == 'cuda')
+        return self.hosts[key][:bs]
+
+    def input(self, shape):
+        # Model input tensor of shape (bs,3,h,w) in channels_last memory format
+        self.requests += 1
+        bs, key = shape[0], tuple(shape[1:])
+        if key not in self.inputs or len(self.inputs[key]) < bs:
+            self.allocations += 1
+            c, h, w = key
+            self.inputs[key] = torch.empty((bs, h, w, c), dtype=self.dtype, device=self.device).permute(0, 3, 1, 2)
+        return self.inputs[key][:bs]
+
+    def to_input(self, host, scale=1 / 255.0, shift=0.0):
+        # Cast a filled host tensor into its model input buffer and normalize it in place, see to_input()
+        x = self.input((host.shape[0], host.shape[3], host.shape[1], host.shape[2]))
+        return to_input(host.permute(0, 3, 1, 2), self.device, self.dtype, scale, shift, out=x)
+
+    def summary(self):
+        # Return 'buffers allocated/requested' so far, i.e. for pipeline_report()
+        return f'input buffers {self.allocations} allocated / {self.requests} requested'
+
+
+class Detector:
+    # YOLOv5 rider / head / number plate detector. The weights load on first use, not on import, with the PyTorch,
+    # TorchScript or ONNX Runtime backend (backends.py), by default chosen from the weights file suffix
+    def __init__(self, weights=yolov5_weight_file, device=device, precision='fp32', conf_thres=conf_set,
+                 iou_thres=0.30, img_size=img_size, tile=False, tile_overlap=0.2, cascade=False, cascade_size=320,
+                 crop_size=320, backend='auto', topk=None):
+        self.weights = weights
+        self.backend_type = backend_type(weights, backend)
+        self.device = torch.device(device)
+        self.img_size = img_size  # inference size, i.e. 320, 416 or 640 to trade resolution for throughput
+        self.tile = tile  # sliced inference on full resolution img_size tiles, see detect_tiled()
+        self.tile_overlap = tile_overlap  # tile overlap fraction, objects cut by one tile border are whole in the next
+        self.cascade = cascade  # two stage inference, see detect_cascade()
+        self.cascade_size = cascade_size  # rider pass input size
+        self.crop_size = crop_size  # head / number plate pass input size of every rider crop
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.topk = topk  # pre-NMS top-k candidates per class, int or one int per class, None for all
+        self.candidates = CandidateStats()  # NMS candidate counts, i.e. for pipeline_report()
+        self._backend = None
+        self.set_precision(precision)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            backend = load_backend(self.weights, self.backend_type, self.device, self.dtype)
+            nc = len(backend.names)
+            assert not isinstance(self.topk, (list, tuple)) or len(self.topk) in (1, nc), \
+                f'topk has {len(self.topk)} values, use one or one per class of the {nc} classes of {self.weights}'
+            self._backend = backend
+            self.img_size = check_img_size(self.img_size, s=self.stride)
+            self.cascade_size = check_img_size(self.cascade_size, s=self.stride)
+            self.crop_size = check_img_size(self.crop_size, s=self.stride)
+            if self._backend.shape:  # exported models take inputs up to their export shape
+                s = min(self._backend.shape)
+                self.img_size, self.cascade_size, self.crop_size = (min(x, s) for x in
+                                                                    (self.img_size, self.cascade_size, self.crop_size))
+            nms = self._backend.nms
+            if nms and (nms['conf'] > self.conf_thres or nms['iou'] != self.iou_thres):
+                print(f"{self.weights} has NMS at conf {nms['conf']} IoU {nms['iou']} in the graph, not the configured "
+                      f'conf {self.conf_thres} IoU {self.iou_thres}, export it again to match')
+        return self._backend
+
+    @property
+    def model(self):
+        return self.backend.model  # torch module, TorchScript module or onnxruntime session
+
+    @property
+    def names(self):
+        return self.backend.names
+
+    @property
+    def stride(self):
+        return self.backend.stride  # model stride
+
+    def set_precision(self, mode='fp32'):
+        # Run in mode ('fp32', 'bf16' or 'fp16') with channels_last inputs, converts the model if already loaded.
+        # Exported backends run in fp32
+        self.dtype = check_precision(mode, self.device)
+        assert self.backend_type == 'torch' or mode == 'fp32', f'{self.backend_type} models are exported in fp32'
+        self.precision = mode
+        self.buffers = BufferPool(self.device, self.dtype)  # preallocated inputs, see BufferPool
+        if self._backend is not None:
+            self._backend.to(self.dtype)
+
+    def warmup(self, shape=(frame_size[1], frame_size[0], 3)):
+        # Load the weights and run one blank frame, so the first camera frame is not slowed down by lazy init
+        self.detect(np.zeros(shape, dtype=np.uint8))
+
+    @inference_mode()
+    def detect(self, frame, draw=False, verbose=False):
+        # Detect on a BGR frame of any size, returns the frame and an (n,6) float32 array of [x1, y1, x2, y2, conf, cls]
+        # detections in frame coordinates. Boxes are drawn on the frame with draw=True and printed with verbose=True
+        backend = self.backend
+        img = self.letterbox(frame, self.img_size)
+
+        pred = self.nms(backend(img))
+        pred[0][:, :4] = scale_coords(img.shape[2:], pred[0][:, :4], frame.shape).round()  # to frame coordinates
+
+        det = pred[0].cpu().numpy()  # single device to host transfer
+        if verbose:
+            log_detections(det, self.names)
+        if draw:
+            frame = draw_detections(frame, det, self.names)
+        return frame, det
+
+    def nms(self, pred, classes=None):
+        # Detections (n,6) [x1, y1, x2, y2, conf, cls] per image of the backend output. Raw predictions run
+        # non_max_suppression(), batches non_max_suppression_batched(). Models exported with NMS output zero-padded
+        # (bs,max_det,6) detections sorted by confidence that only need slicing to conf_thres
+        if not self.backend.nms:
+            nms = non_max_suppression_batched if len(pred) > 1 else non_max_suppression
+            stats = {}
+            dets = nms(pred, self.conf_thres, self.iou_thres, classes=classes, topk=self.topk, stats=stats)
+            self.candidates.update(stats)
+            return dets
+        dets = [x[:int((x[:, 4] > self.conf_thres).sum())] for x in pred]
+        if classes is not None:
+            dets = [x[(x[:, 5:6] == x.new_tensor(classes)).any(1)] for x in dets]
+        return dets
+
+    def letterbox(self, frame, size, auto=True):
+        # Letterbox a BGR frame into a preallocated RGB host buffer, as the utils.datasets loaders feed the model, and
+        # return the (1,3,h,w) model input buffer it is cast into. Inputs of fixed shape backends are not cut to the
+        # minimum rectangle, so they need no further padding
+        auto = auto and not self.backend.shape
+        host = self.buffers.host((1, *letterbox_shape(frame.shape, size, auto=auto, stride=self.stride), 3))
+        img = host.numpy()[0]
+        letterbox_into(frame, img)  # padded resize
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+        return self.buffers.to_input(host)
+
+    def tiles(self, shape, mask=None):
+        # Top-left (x, y) corners of the overlapping img_size tiles covering an image of shape (h, w). Tiles without a
+        # moving pixel in the motion mask (any resolution, i.e. MotionGate.mask) are skipped
+        h, w = shape[:2]
+        t = self.img_size
+        step = max(int(t * (1 - self.tile_overlap)), self.stride)
+        xs, ys = (np.linspace(0, max(n - t, 0), math.ceil(max(n - t - self.stride, 0) / step) + 1).round().astype(int)
+                  for n in (w, h))  # evenly spaced, a border strip narrower than the stride adds no tile
+        corners = [(x, y) for y in ys.tolist() for x in xs.tolist()]
+        if mask is not None:
+            sx, sy = mask.shape[1] / w, mask.shape[0] / h
+            corners = [(x, y) for x, y in corners
+                       if mask[int(y * sy):math.ceil((y + t) * sy), int(x * sx):math.ceil((x + t) * sx)].any()]
+        return corners
+
+    @inference_mode()
+    def detect_tiled(self, frame, mask=None, draw=False, verbose=False, batch_size=16):
+        # Sliced inference for high resolution cameras, same output as detect(). The frame is cut into overlapping
+        # full resolution img_size tiles, batched with the whole frame letterboxed to img_size (for riders larger than
+        # a tile) into forwards of at most batch_size images. The raw predictions are shifted to frame coordinates and
+        # merged by one non_max_suppression() over all tiles. Tiles without motion in mask are not run
+        backend = self.backend
+        t = self.img_size
+        if frame.shape[0] <= t and frame.shape[1] <= t:  # a single tile
+            return self.detect(frame, draw, verbose)
+        assert not backend.nms, 'tiles are merged by one NMS over their raw predictions, export the model without --nms'
+
+        corners = self.tiles(frame.shape, mask)
+        images = [None] + corners  # whole frame, then the tiles
+        preds = []
+        for i in range(0, len(images), batch_size):  # batches of at most batch_size images bound the memory
+            host = self.buffers.host((len(images[i:i + batch_size]), t, t, 3))
+            batch = host.numpy()
+            for b, corner in zip(batch, images[i:i + batch_size]):
+                if corner is None:
+                    ratio, (dw, dh) = letterbox_into(frame, b)  # whole frame
+                else:
+                    x, y = corner
+                    tile = frame[y:y + t, x:x + t]
+                    b[:tile.shape[0], :tile.shape[1]] = tile
+                    b[tile.shape[0]:], b[:, tile.shape[1]:] = 114, 114  # pad tiles at the frame border
+                cv2.cvtColor(b, cv2.COLOR_BGR2RGB, dst=b)
+            preds.append(backend(self.buffers.to_input(host)))
+
+        pred = torch.cat(preds, 0)  # (1 + tiles, n, 5 + nc) xywh predictions in tile pixels
+        pred[0, :, :2] -= pred.new_tensor([dw, dh])  # whole frame to frame coordinates
+        pred[0, :, :4] /= ratio[0]
+        if corners:
+            pred[1:, :, :2] += pred.new_tensor(corners)[:, None]  # tile offsets
+        stats = {}
+        pred = non_max_suppression(pred.reshape(1, -1, pred.shape[2]), self.conf_thres, self.iou_thres, topk=self.topk,
+                                   stats=stats)  # merge
+        self.candidates.update(stats)
+        clip_coords(pred[0], frame.shape)
+        pred[0][:, :4] = pred[0][:, :4].round()  # integer pixels as detect()
+
+        det = pred[0].cpu().numpy()  # single device to host transfer
+        if verbose:
+            log_detections(det, self.names)
+        if draw:
+            frame = draw_detections(frame, det, self.names)
+        return frame, det
+
+    @inference_mode()
+    def detect_cascade(self, frame, draw=False, verbose=False, margin=0.1, batch_size=16):
+        # Two stage inference, same output as detect(). A cheap cascade_size pass finds the riders, then the rider
+        # crops (margin padded) are letterboxed, mostly upscaled, to crop_size and batched into one more forward that
+        # finds the heads and number plates at a resolution the full frame pass could not afford. Padded crops can
+        # overlap, so the heads and plates of all crops are merged by one per-class NMS
+        backend = self.backend
+        img = self.letterbox(frame, self.cascade_size)
+        riders = self.nms(backend(img), classes=[0])[0]
+        riders[:, :4] = scale_coords(img.shape[2:], riders[:, :4], frame.shape).round()
+
+        if len(riders):
+            h, w = frame.shape[:2]
+            wh = riders[:, 2:4] - riders[:, :2]
+            boxes = torch.cat((riders[:, :2] - wh * margin, riders[:, 2:4] + wh * margin), 1)
+            boxes = boxes.round().int().cpu().numpy().clip(0, [w, h, w, h])
+            keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])  # riders in the letterbox padding are
+            riders, boxes = riders[torch.from_numpy(keep).to(riders.device)], boxes[keep]  # clipped to empty crops
+        dets = []  # heads and plates of every crop
+        if len(riders):
+            for i in range(0, len(boxes), batch_size):  # batches of at most batch_size riders bound the memory
+                crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in boxes[i:i + batch_size].tolist()]
+                host = self.buffers.host((len(crops), self.crop_size, self.crop_size, 3))
+                for b, crop in zip(host.numpy(), crops):
+                    letterbox_into(crop, b)
+                    cv2.cvtColor(b, cv2.COLOR_BGR2RGB, dst=b)
+                img = self.buffers.to_input(host)
+                pred = self.nms(backend(img), classes=[1, 2])  # heads, plates
+                for det, crop, (x1, y1, _, _) in zip(pred, crops, boxes[i:i + batch_size].tolist()):
+                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], crop.shape).round()  # to crop coordinates
+                    det[:, :4] += det.new_tensor([x1, y1, x1, y1])  # to frame coordinates
+                    dets.append(det)
+        det = riders
+        if dets:
+            dets = torch.cat(dets, 0)
+            keep = torchvision.ops.batched_nms(dets[:, :4], dets[:, 4], dets[:, 5], self.iou_thres)  # merge crops
+            det = torch.cat((riders, dets[keep]), 0)
+
+        det = det.cpu().numpy()  # single device to host transfer
+        if verbose:
+            log_detections(det, self.names)
+        if draw:
+            frame = draw_detections(frame, det, self.names)
+        return frame, det
+
+    @inference_mode()
+    def detect_batch(self, img, im0s, verbose=False):
+        # Detect on a letterboxed uint8 batch img(bs,3,h,w) from one forward, i.e. LoadStreams output, and return the
+        # (n,6) detections array of every image in its original im0s coordinates
+        img = to_input(torch.from_numpy(img), self.device, self.dtype, out=self.buffers.input(img.shape))
+
+        pred = self.nms(self.backend(img))
+
+        for det, im0 in zip(pred, im0s):
+            det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()  # to im0 coordinates
+        n = [det.shape[0] for det in pred]  # detections per image
+        dets = np.split(torch.cat(pred, 0).cpu().numpy(), np.cumsum(n)[:-1])  # single device to host transfer
+        if verbose:
+            for det in dets:
+                log_detections(det, self.names)
+        return dets
+
+
+class HelmetClassifier:
+    # Helmet / no helmet head classifier (model2). The weights load on first use, not on import, as a pickled module
+    # or its TorchScript or ONNX export (models/export.py --classifier), chosen from the weights file suffix
+    def __init__(self, weights=helmet_classifier_weight, device=device, precision='fp32',
+                 threshold=head_classification_threshold, channel_order='BGR', backend='auto'):
+        assert channel_order in ('BGR', 'RGB'), f'unknown channel order {channel_order}'
+        self.weights = weights
+        self.backend_type = backend_type(weights, backend)
+        self.device = torch.device(device)
+        self.threshold = threshold  # confident score threshold, see helmet_result()
+        self.channel_order = channel_order  # classifier input channel order, BGR as the crops were always fed so far
+        self.buffer = np.zeros((0, head_size, head_size, 3), dtype=np.uint8)  # letterboxed crops, grows as needed
+        self.input = None  # preallocated model input, the size of buffer
+        self._model = None
+        self.set_precision(precision)
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = load_classifier(self.weights, self.backend_type, self.device, self.dtype)
+        return self._model
+
+    def set_precision(self, mode='fp32'):
+        # Run in mode ('fp32', 'bf16' or 'fp16') with channels_last inputs, converts the model if already loaded.
+        # Exported models run in fp32
+        self.dtype = check_precision(mode, self.device)
+        assert self.backend_type == 'torch' or mode == 'fp32', f'{self.backend_type} models are exported in fp32'
+        self.precision = mode
+        self.input = None
+        if self._model is not None and self.backend_type == 'torch':
+            self._model.to(dtype=self.dtype, memory_format=torch.channels_last)
+
+    @inference_mode()
+    def preprocess(self, frames):
+        # Head crops to a normalized (n,3,head_size,head_size) model input without PIL or per crop allocations: every
+        # crop is letterboxed by cv2.resize straight into the preallocated uint8 buffer, then one cast and copy into
+        # the preallocated input tensor is normalized in place to [-1, 1], as ToTensor() + Normalize([0.5], [0.5])
+        n = len(frames)
+        if len(self.buffer) < n or self.input is None:
+            self.buffer = np.zeros((max(n, len(self.buffer)), head_size, head_size, 3), dtype=np.uint8)
+            self.input = torch.empty((len(self.buffer), 3, head_size, head_size), dtype=self.dtype,
+                                     device=self.device).contiguous(memory_format=torch.channels_last)
+        buffer = self.buffer[:n]
+        for b, f in zip(buffer, frames):
+            letterbox_into(f, b)
+            if self.channel_order == 'RGB':
+                cv2.cvtColor(b, cv2.COLOR_BGR2RGB, dst=b)
+        return to_input(torch.from_numpy(buffer).permute(0, 3, 1, 2), self.device, self.dtype, 1 / 127.5, -1.0,
+                        out=self.input[:n])
+
+    def warmup(self, n=1):
+        # Load the weights and classify n blank heads
+        self.classify_batch([np.zeros((head_size, head_size, 3), dtype=np.uint8)] * n)
+
+    def classify(self, frame):
+        return self.classify_batch([frame])[0]
+
+    @inference_mode()
+    def classify_batch(self, frames):
+        # Classify a list of head crops with a single forward, returns [helmet, score] per crop in input order
+        results = [[None, 0] for _ in frames]
+        keep = [i for i, f in enumerate(frames) if f.shape[0] >= 5 and f.shape[1] > 0]  # skipping small size heads
+        if not keep:
+            return results
+
+        prediction = self.model(self.preprocess([frames[i] for i in keep])).float()
+        top2 = prediction.topk(2, 1)[0]
+        cs = (top2[:, 0] - top2[:, 1]).tolist()  # confident scores
+        result_idx = prediction.argmax(1).tolist()
+        for i, r, c in zip(keep, result_idx, cs):
+            results[i] = helmet_result(r, c, self.threshold)
+        return results
+
+
+def helmet_result(result_idx, cs, threshold=head_classification_threshold):
+    # Map classifier argmax and confident score to [helmet, score], helmet is None when not confident
+    if cs > threshold:  # < --- Classification confident score. Need to adjust, this value
+        return [True, cs] if result_idx == 0 else [False, cs]
+    else:
+        return [None, cs]
+
+
+def int8_weights(weights, suffix):
+    # Path of the int8 model quantize.py saves next to weights, i.e. model.pt to model.int8.torchscript.pt
+    return str(Path(weights).with_suffix('')) + '.int8' + suffix
+
+
+def configure(config_file='config.ini', warmup=None, **overrides):
+    # (Re)create the default detector and classifier from the [models] section of config_file, non-None overrides
+    # (detector, backend, classifier, precision, img_size, tile, tile_overlap, cascade, cascade_size, crop_size,
+    # conf_thres, topk, head_classification_threshold, classifier_channels, quantized) win, i.e. command line
+    # arguments. quantized runs the int8 models of quantize.py on CPU, topk is one or one per class pre-NMS top-k
+    # limit (comma separated in config_file, empty for none). Weights still load lazily unless warmup (or warmup = true
+    # in config_file) runs a blank frame through both models
+    global detector, classifier
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    def get(k, fallback):
+        return overrides[k] if overrides.get(k) is not None else config.get('models', k, fallback=fallback)
+
+    precision = get('precision', 'fp32')
+    tile, cascade, quantized = (overrides.get(k) if overrides.get(k) is not None else
+                                config.getboolean('models', k, fallback=False)
+                                for k in ('tile', 'cascade', 'quantized'))
+    detector_weights = get('detector', yolov5_weight_file)
+    topk = get('topk', '')
+    if isinstance(topk, str):
+        topk = [int(x) for x in topk.replace(',', ' ').split()]
+    if isinstance(topk, (list, tuple)):
+        topk = (topk[0] if len(topk) == 1 else list(topk)) if topk else None
+    classifier_weights = get('classifier', helmet_classifier_weight)
+    if quantized:
+        assert precision == 'fp32', 'int8 models run with precision fp32'
+        detector_weights = int8_weights(detector_weights, '.torchscript.pt')
+        classifier_weights = int8_weights(classifier_weights, '.pth')
+    dev = 'cpu' if quantized else device  # quantized kernels are CPU only
+    detector = Detector(detector_weights, dev, precision=precision,
+                        conf_thres=float(get('conf_thres', conf_set)), img_size=int(get('img_size', img_size)),
+                        tile=tile, tile_overlap=float(get('tile_overlap', 0.2)), cascade=cascade,
+                        cascade_size=int(get('cascade_size', 320)), crop_size=int(get('crop_size', 320)),
+                        backend=get('backend', 'auto'), topk=topk)
+    classifier = HelmetClassifier(classifier_weights, dev, precision=precision,
+                                  threshold=float(get('head_classification_threshold', head_classification_threshold)),
+                                  channel_order=get('classifier_channels', 'BGR'))
+    if warmup if warmup is not None else config.getboolean('models', 'warmup', fallback=False):
+        detector.warmup()
+        classifier.warmup()
+    return detector, classifier
+
+
+configure(warmup=False)  # default instances, nothing is loaded until the first detection
+
+
+def __getattr__(name):
+    # Module attributes of the default instances for older callers, i.e. my_functions.model, my_functions.stride
+    if name in ('model', 'names', 'stride'):
+        return getattr(detector, name)
+    if name == 'model2':
+        return classifier.model
+    raise AttributeError(f"module 'my_functions' has no attribute '{name}'")
+
+
+def set_precision(mode='fp32'):
+    # Run the default detector and classifier in mode ('fp32', 'bf16' or 'fp16'), see Detector.set_precision()
+    detector.set_precision(mode)
+    classifier.set_precision(mode)
+    return mode
+
+
+def image_classify(frame):
+    return classifier.classify(frame)
+
+
+def image_classify_batch(frames):
+    # Classify a list of head crops with a single model2 forward, returns [helmet, score] per crop in input order
+    return classifier.classify_batch(frames)
+
+
+def object_detection(frame, draw=False, verbose=False, mask=None):
+    # Detect on a frame with the default detector, see Detector.detect(). In tile mode the frame is sliced, skipping
+    # tiles without motion in mask, see Detector.detect_tiled(). Cascade mode is Detector.detect_cascade()
+    if detector.tile:
+        return detector.detect_tiled(frame, mask, draw, verbose)
+    if detector.cascade:
+        return detector.detect_cascade(frame, draw, verbose)
+    return detector.detect(frame, draw, verbose)
+
+
+def object_detection_batch(img, im0s, verbose=False):
+    # Detect on a letterboxed uint8 batch with the default detector, see Detector.detect_batch()
+    return detector.detect_batch(img, im0s, verbose)
+
+
+detection_dtype = np.dtype([(k, np.float32) for k in ('x1', 'y1', 'x2', 'y2', 'conf', 'cls')])
+
+
+def detections_view(det):
+    # Structured zero-copy view of an (n,6) detections array, i.e. detections_view(det).conf
+    return np.ascontiguousarray(det, dtype=np.float32).view(detection_dtype).view(np.recarray)[:, 0]
+
+
+def log_detections(det, names=None):
+    # Print one line per detection
+    names = names or detector.names
+    for (x1, y1, x2, y2), conf, c in zip(det[:, :4].astype(int).tolist(), det[:, 4].tolist(), det[:, 5].tolist()):
+        print(f'Detected: {names[int(c)]} conf: {conf:.2f}  bbox: x1:{x1}    y1:{y1}    x2:{x2}    y2:{y2}')
+
+
+def draw_detections(frame, det, names=None):
+    # Draw detector boxes, with name and confidence for non-head boxes
+    names = names or detector.names
+    boxes, confs, classes = det[:, :4].astype(int).tolist(), det[:, 4].tolist(), det[:, 5].astype(int).tolist()
+    for (x1, y1, x2, y2), conf, c in zip(boxes, confs, classes):
+        frame = cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 1)  # box
+        if c != 1:  # if it is not a head bbox, then write use putText
+            frame = cv2.putText(frame, f'{names[c]} {conf:.2f}', (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                                (0, 0, 255), 1, cv2.LINE_AA)
+    return frame
+
+
+def is_bounding_box_inside(big_box, small_box):
+    x1 = small_box[0] - big_box[0]
+    y1 = small_box[1] - big_box[1]
+    x2 = big_box[2] - small_box[2]
+    y2 = big_box[3] - small_box[3]
+    return not bool(min([x1, y1, x2, y2, 0]))
+
+
+def box_containment(big_boxes, small_boxes):
+    # Vectorized is_bounding_box_inside(), returns the (n,m) bool matrix of small_boxes[j] inside big_boxes[i]
+    big = np.asarray(big_boxes, dtype=np.float32).reshape(-1, 4)[:, None]  # (n,1,4)
+    small = np.asarray(small_boxes, dtype=np.float32).reshape(-1, 4)[None]  # (1,m,4)
+    return (small[..., :2] >= big[..., :2]).all(2) & (small[..., 2:] <= big[..., 2:]).all(2)
+
+
+def associate(detections):
+    # Assign the most confident head and number plate inside every rider, detections is an (n,6) array-like of
+    # [x1, y1, x2, y2, conf, cls]. Returns (riders, heads, plates) index arrays into detections, one entry per rider,
+    # with -1 where a rider contains no head or plate
+    det = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+    riders = np.nonzero(det[:, 5] == 0)[0]
+    assignment = [riders]
+    for c in 1, 2:  # head, number plate
+        idx = np.nonzero(det[:, 5] == c)[0]
+        if not len(idx):
+            assignment.append(np.full(len(riders), -1))
+            continue
+        inside = box_containment(det[riders, :4], det[idx, :4])  # (riders, n)
+        best = np.where(inside, det[idx, 4][None], -1.0).argmax(1)  # most confident contained box
+        assignment.append(np.where(inside.any(1), idx[best], -1))
+    return tuple(assignment)
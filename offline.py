@@ -0,0 +1,191 @@
+"""Headless batch processing of recorded footage, i.e. for audits
+
+Videos are split into frame-range shards that a process pool analyses in parallel, each shard in batches of frames per
+detector forward, so throughput scales with the core count instead of the playback speed. The violations of all
+shards are merged into one CSV report.
+
+Usage:
+    $ python offline.py --source recordings/ --workers 4
+    $ python offline.py --source clip1.mp4 clip2.mp4 --shard-frames 2000 --batch-size 8
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils.datasets import LoadImages, letterbox
+
+
+def find_files(sources):
+    # (path, is_video) of every image and video in sources, files, directories or globs as utils.datasets.LoadImages
+    files = []
+    for source in sources:
+        dataset = LoadImages(source)
+        if dataset.cap is not None:
+            dataset.cap.release()
+        files += zip(dataset.files, dataset.video_flag)
+    return files
+
+
+def make_shards(files, shard_frames=1000):
+    # Split videos into (path, start, end) frame ranges of shard_frames frames, images are one shard each
+    shards = []
+    for path, is_video in files:
+        if not is_video:
+            shards.append((path, None, None))
+            continue
+        cap = cv2.VideoCapture(path)
+        n = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        shards += [(path, start, min(start + shard_frames, n)) for start in range(0, n, shard_frames)]
+    return shards
+
+
+def read_batches(path, start, end, batch_size=8):
+    # Yield ([frame index], [frame]) batches of the video frames start to end, images are a single batch
+    if start is None:
+        yield [0], [cv2.imread(path)]
+        return
+    cap = cv2.VideoCapture(path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    indices, frames = [], []
+    for i in range(start, end):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        indices.append(i)
+        frames.append(frame)
+        if len(frames) == batch_size:
+            yield indices, frames
+            indices, frames = [], []
+    cap.release()
+    if frames:
+        yield indices, frames
+
+
+def init_worker(config_file, overrides, threads):
+    # Pool worker initializer: default models from config_file and an even share of the CPU threads
+    import torch
+    import my_functions
+
+    torch.set_num_threads(threads)
+    my_functions.configure(config_file, warmup=False, **overrides)
+
+
+def process_shard(shard, output_folder, batch_size=8, prefix=''):
+    # Analyse one shard, returns the violation report rows, the number of frames and the processing time (s). prefix
+    # makes the crop names unique across shards and runs, track ids and crop counters restart in every shard
+    import my_functions
+    from main import analyse_detections
+    from pipeline import CropWriter
+    from tracker import Tracker
+
+    path, start, end = shard
+    detector = my_functions.detector
+    stride = detector.stride
+    stem = f'{prefix}{Path(path).stem}' if start is None else f'{prefix}{Path(path).stem}_{start}'
+    fps = 0.0
+    if start is not None:
+        cap = cv2.VideoCapture(path)
+        fps = cap.get(cv2.CAP_PROP_FPS) % 100 or 30.0
+        cap.release()
+
+    t = time.time()
+    tracker = Tracker()
+    writer = CropWriter(output_folder, timeout=None)  # audits never drop crops, block instead
+    rows, n, i = [], 0, 0
+
+    def report(violations, i):
+        # Queue the crops and add a report row for every violation track finished at frame i
+        for track in violations:
+            rider_img, num_img, conf_num = track.crops
+            rider_path = writer.put('riders_pictures', f'{stem}_{track.id}', rider_img)
+            plate_path = writer.put('number_plates', f'{stem}_{track.id}_{conf_num:.2f}', num_img) \
+                if num_img is not None else None
+            last = i - track.time_since_update  # last frame the rider was detected in
+            rows.append({'file': path, 'first_frame': i - track.age, 'last_frame': last,
+                         'time': f'{last / fps:.2f}' if fps else '', 'score': f'{track.decision()[1]:.2f}',
+                         'rider_crop': rider_path or '', 'plate_crop': plate_path or '',
+                         'plate_conf': f'{conf_num:.2f}'})
+
+    for indices, frames in read_batches(path, start, end, batch_size):
+        if frames[0] is None:  # unreadable image
+            break
+        shapes = {f.shape for f in frames}
+        if len(shapes) == 1:  # one forward for the batch
+            img = np.stack([letterbox(f, detector.img_size, stride=stride)[0] for f in frames], 0)
+            img = np.ascontiguousarray(img[..., ::-1].transpose(0, 3, 1, 2))  # BGR to RGB, to bsx3xhxw
+            dets = detector.detect_batch(img, frames)
+        else:
+            dets = [detector.detect(f)[1] for f in frames]
+        for i, frame, det in zip(indices, frames, dets):
+            _, violations = analyse_detections(frame, det, tracker)
+            report(violations, i)
+        n += len(frames)
+
+    report([x for x in tracker.flush() if x.is_violation], i)  # riders still in view at the end of the shard
+    writer.close()
+    return rows, n, time.time() - t
+
+
+def run(sources, output_folder='output_folder/offline', workers=None, shard_frames=1000, batch_size=8,
+        config_file='config.ini', **overrides):
+    # Process all sources with a pool of workers and write the merged violation report, returns the report path
+    workers = workers or os.cpu_count()
+    os.makedirs(output_folder, exist_ok=True)
+    shards = make_shards(find_files(sources), shard_frames)
+    workers = max(1, min(workers, len(shards)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f'{len(shards)} shards on {workers} workers x {threads} threads')
+
+    t = time.time()
+    current_datetime = time.strftime("%Y%m%d_%H%M%S")  # run time stamp of the crop names and the report
+    rows, frames = [], 0
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(workers, initializer=init_worker, initargs=(config_file, overrides, threads)) as pool:
+        jobs = [pool.apply_async(process_shard, (shard, output_folder, batch_size, f'{current_datetime}_{k}_'))
+                for k, shard in enumerate(shards)]
+        for k, job in enumerate(jobs, 1):
+            shard_rows, n, dt = job.get()
+            rows += shard_rows
+            frames += n
+            print(f'shard {k}/{len(shards)}: {n} frames in {dt:.1f}s, {len(shard_rows)} violations')
+
+    rows.sort(key=lambda x: (x['file'], x['first_frame']))
+    report_path = os.path.join(output_folder, f'report_{current_datetime}.csv')
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['file', 'first_frame', 'last_frame', 'time', 'score', 'rider_crop',
+                                               'plate_crop', 'plate_conf'])
+        writer.writeheader()
+        writer.writerows(rows)
+    dt = time.time() - t
+    print(f'{frames} frames in {dt:.1f}s ({frames / dt:.1f} FPS), {len(rows)} violations, '
+          f'report saved to {report_path}')
+    return report_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', nargs='+', required=True, help='video / image files, directories or globs')
+    parser.add_argument('--output', type=str, default='output_folder/offline', help='crops and report folder')
+    parser.add_argument('--workers', type=int, help='worker processes, default one per CPU core')
+    parser.add_argument('--shard-frames', type=int, default=1000, help='video frames per shard')
+    parser.add_argument('--batch-size', type=int, default=8, help='frames per detector forward')
+    parser.add_argument('--config', type=str, default='config.ini', help='config file with a [models] section')
+    parser.add_argument('--weights', type=str, help='detector weights, overrides the config file')
+    parser.add_argument('--backend', type=str, choices=['auto', 'torch', 'torchscript', 'onnx'], help='detector backend')
+    parser.add_argument('--img-size', type=int, help='detector input size, overrides the config file')
+    parser.add_argument('--int8', action='store_true', default=None,
+                        help='run the int8 models of quantize.py on CPU')
+    parser.add_argument('--topk', nargs='+', type=int, help='pre-NMS candidates kept per class, one or one per class')
+    parser.add_argument('--precision', type=str, choices=['fp32', 'bf16', 'fp16'], help='inference precision')
+    opt = parser.parse_args()
+
+    run(opt.source, opt.output, opt.workers, opt.shard_frames, opt.batch_size, opt.config, detector=opt.weights,
+        backend=opt.backend, img_size=opt.img_size, precision=opt.precision, quantized=opt.int8, topk=opt.topk)
@@ -0,0 +1,195 @@
+# pipeline.py
+# Bounded queues, latency statistics and the background crop writer of the threaded capture / inference / output
+# pipeline in main.py
+
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+
+class FrameQueue:
+    # Bounded queue between two pipeline stages. A full queue never blocks the producer, it drops either the
+    # oldest queued item ('drop-oldest', keeps the newest frames flowing) or the incoming item ('drop-newest')
+    def __init__(self, maxsize=2, policy='drop-oldest'):
+        assert policy in ('drop-oldest', 'drop-newest'), f'unknown drop policy {policy}'
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.dropped = 0  # number of items dropped so far
+        self.closed = False
+
+    def put(self, item):
+        # Queue item according to the drop policy, returns True if item was queued
+        with self.lock:
+            if self.closed:
+                return False
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    return True
+                except queue.Full:
+                    if self.policy == 'drop-newest':
+                        self.dropped += 1
+                        return False
+                    self.drop_oldest()
+
+    def get(self, timeout=None):
+        # Next item, None once the producer closed the queue
+        return self.queue.get(timeout=timeout)
+
+    def close(self):
+        # Signal end of stream, the None sentinel is always delivered even if that means dropping a queued item
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            while True:
+                try:
+                    self.queue.put_nowait(None)
+                    return
+                except queue.Full:
+                    self.drop_oldest()
+
+    def drop_oldest(self):
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+        except queue.Empty:
+            pass
+
+    def __len__(self):
+        return self.queue.qsize()  # current queue depth
+
+
+class StageStats:
+    # Latency statistics of a pipeline stage over the current report window
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.n, self.total, self.max = 0, 0.0, 0.0
+
+    def update(self, dt):
+        # Record one item processed in dt seconds
+        with self.lock:
+            self.n += 1
+            self.total += dt
+            self.max = max(self.max, dt)
+
+    def summary(self):
+        # Return 'name mean/max ms' for the window and start a new window
+        with self.lock:
+            n, total, mx = self.n, self.total, self.max
+            self.n, self.total, self.max = 0, 0.0, 0.0
+        mean = total / n if n else 0.0
+        return f'{self.name} {mean * 1E3:.1f}/{mx * 1E3:.1f}ms ({n})'
+
+
+class CandidateStats:
+    # NMS candidate counts (non_max_suppression() stats) over the current report window, i.e. to see how close crowded
+    # scenes get to the pre-NMS top-k limit
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.n, self.total, self.max = 0, {}, {}
+
+    def update(self, counts):
+        # Record the counts of one NMS call
+        with self.lock:
+            self.n += 1
+            for k, v in counts.items():
+                self.total[k] = self.total.get(k, 0) + v
+                self.max[k] = max(self.max.get(k, 0), v)
+
+    def summary(self):
+        # Return 'NMS count mean/max > ...' per call for the window and start a new window
+        with self.lock:
+            n, total, mx = self.n, self.total, self.max
+            self.n, self.total, self.max = 0, {}, {}
+        s = ' > '.join(f'{k} {v / n:.0f}/{mx[k]}' for k, v in total.items()) if n else 'no calls'
+        return f'NMS {s} ({n})'
+
+
+class RateLimiter:
+    # ready() returns True at most fps times per second, i.e. for a low rate preview window. fps <= 0 is no limit
+    def __init__(self, fps=0.0):
+        self.interval = 1 / fps if fps > 0 else 0.0
+        self.last = 0.0
+
+    def ready(self):
+        t = time.monotonic()
+        if t - self.last < self.interval:
+            return False
+        self.last = t
+        return True
+
+
+def pipeline_report(stats, queues):
+    # One-line report of per-stage mean/max latency and queue depths, i.e. for periodic printing
+    s = ', '.join(x.summary() for x in stats)
+    q = ', '.join(f'{k} {len(v)}/{v.maxsize} ({v.dropped} dropped)' for k, v in queues.items())
+    return f'Pipeline: {s} | queues: {q}'
+
+
+class CropWriter:
+    # Background JPEG writer for rider and number plate crops. put() queues a crop and returns at once, a pool of
+    # writer threads encodes and writes it (cv2 releases the GIL). When the bounded queue stays full for timeout
+    # seconds the crop is dropped, so a burst of violations never stalls inference
+    def __init__(self, folder, workers=2, maxsize=64, timeout=0.05):
+        self.folder = folder
+        self.timeout = timeout  # seconds put() waits for a free queue slot before dropping the crop
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.count = 0  # crops named so far, makes every file name unique
+        self.written, self.dropped, self.failed = 0, 0, 0
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, subdir, stem, img):
+        # Queue img for writing to folder/subdir/stem_count.jpg, returns the path or None if the crop was dropped
+        with self.lock:
+            self.count += 1
+            path = os.path.join(self.folder, subdir, f'{stem}_{self.count:05d}.jpg')
+        try:
+            self.queue.put((path, img), timeout=self.timeout)
+            return path
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return None
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:  # close()
+                break
+            path, img = item
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                ok = cv2.imwrite(path, img)
+            except (cv2.error, OSError) as e:
+                print(f'could not save {path}: {e}')
+                ok = False
+            with self.lock:
+                if ok:
+                    self.written += 1
+                else:
+                    self.failed += 1
+
+    def close(self):
+        # Write all queued crops and stop the writer threads
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __len__(self):
+        return self.queue.qsize()  # crops waiting to be written
+
+    def summary(self):
+        # Return 'crops written/dropped/failed' so far, i.e. for pipeline_report()
+        with self.lock:
+            return f'crops {self.written} written, {self.dropped} dropped, {self.failed} failed ({len(self)} queued)'
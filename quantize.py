@@ -0,0 +1,210 @@
+"""Post-training int8 quantization of the detector and the helmet classifier, for CPU-only deployments
+
+The detector is statically quantized with torch.fx and calibrated on a folder of saved frames, its Detect() head stays
+fp32. The Linear layers of the classifier (model2) are dynamically quantized. The int8 models are saved next to the
+fp32 weights as *.int8.torchscript.pt and *.int8.pth and load with quantized = true in config.ini [models] or
+main.py --int8. The report compares int8 with fp32: detector mAP against the fp32 detections as pseudo-labels
+(utils.metrics.ap_per_class), classifier agreement, and latency
+
+Usage:
+    $ python quantize.py --calib saved_frames/ --val val_frames/
+    $ python quantize.py --calib saved_frames/ --engine qnnpack  # ARM CPUs
+"""
+
+import argparse
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from benchmark import timeit
+from models.experimental import attempt_load
+from my_functions import Detector, HelmetClassifier, int8_weights
+from utils.datasets import LoadImages, letterbox
+from utils.general import box_iou, check_img_size, non_max_suppression
+from utils.metrics import ap_per_class
+
+
+def load_frames(source, n=200):
+    # Up to n BGR frames of the images and videos in source, a file, directory or glob as utils.datasets.LoadImages
+    frames = []
+    for _, _, im0, cap in LoadImages(source):
+        frames.append(im0)
+        if len(frames) >= n:
+            if cap is not None:
+                cap.release()
+            break
+    assert frames, f'no images or videos in {source}'
+    return frames
+
+
+def to_tensor(frame, img_size):
+    # BGR frame to the fixed shape (1,3,img_size,img_size) fp32 model input of the exported detectors
+    img = letterbox(frame, img_size, auto=False)[0][:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3xhxw
+    return torch.from_numpy(np.ascontiguousarray(img))[None].float() / 255.0
+
+
+class Backbone(nn.Module):
+    # Model.forward_once() up to the Detect() head without profiling, traceable by torch.fx. Returns the Detect() inputs
+    def __init__(self, model):
+        super().__init__()
+        self.model = model.model[:-1]
+        self.save = model.save
+        self.f = model.model[-1].f  # Detect() input layers
+
+    def forward(self, x):
+        y = []  # outputs
+        for m in self.model:
+            if m.f != -1:  # if not from previous layer
+                x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+            x = m(x)
+            y.append(x if m.i in self.save else None)  # save output
+        return [x if j == -1 else y[j] for j in self.f]
+
+
+class QuantizedDetector(nn.Module):
+    # int8 backbone followed by the fp32 Detect() head, called like the fp32 Model
+    def __init__(self, backbone, detect):
+        super().__init__()
+        self.backbone = backbone
+        self.detect = detect
+
+    def forward(self, x):
+        return self.detect(list(self.backbone(x)))
+
+
+def quantize_detector(weights, frames, img_size=640, engine='x86'):
+    # Static post-training quantization calibrated on frames, saves the traced int8 model, returns its path
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = engine
+    model = attempt_load(weights, map_location='cpu')  # fused fp32 model
+    stride = int(model.stride.max())
+    img_size = check_img_size(img_size, s=stride)
+    model.model[-1].export = False  # Detect() grid, raw predictions for non_max_suppression()
+
+    example = torch.zeros(1, 3, img_size, img_size)
+    backbone = prepare_fx(Backbone(model).eval(), get_default_qconfig_mapping(engine), (example,))
+    with torch.no_grad():
+        for frame in frames:  # calibrate the activation observers
+            backbone(to_tensor(frame, img_size))
+        qmodel = QuantizedDetector(convert_fx(backbone), model.model[-1]).eval()
+        for _ in range(2):
+            qmodel(example)  # dry runs
+        ts = torch.jit.trace(qmodel, example, strict=False)
+
+    f = int8_weights(weights, '.torchscript.pt')
+    meta = {'names': model.names, 'stride': stride, 'img_size': [img_size, img_size], 'batch_size': 1, 'grid': True,
+            'dynamic': False, 'engine': engine}  # see backends.py
+    ts.save(f, _extra_files={'config.txt': json.dumps(meta)})
+    print(f'detector: {len(frames)} calibration frames, saved as {f}')
+    return f
+
+
+def quantize_classifier(weights):
+    # Dynamic quantization of the classifier Linear layers, saves the int8 model, returns its path
+    model = torch.load(weights, map_location='cpu').float().eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    f = int8_weights(weights, '.pth')
+    torch.save(model, f)
+    print(f'classifier: saved as {f}')
+    return f
+
+
+def match_predictions(pred, labels, iouv):
+    # (n,len(iouv)) bool matrix of predictions pred(n,6) that match a label box labels(m,6) of their class, at every
+    # IoU threshold in iouv, each label matched once as in YOLOv5 test.py
+    correct = torch.zeros(len(pred), len(iouv), dtype=torch.bool)
+    detected = set()
+    for cls in torch.unique(labels[:, 5]):
+        ti = (labels[:, 5] == cls).nonzero().view(-1)
+        pi = (pred[:, 5] == cls).nonzero().view(-1)
+        if len(pi):
+            ious, i = box_iou(pred[pi, :4], labels[ti, :4]).max(1)  # best label per prediction
+            for j in (ious > iouv[0]).nonzero().view(-1).tolist():
+                d = ti[i[j]].item()
+                if d not in detected:
+                    detected.add(d)
+                    correct[pi[j]] = ious[j] > iouv
+    return correct
+
+
+@torch.no_grad()
+def evaluate(detector, reference, frames, label_conf=0.25):
+    # mAP@0.5 and mAP@0.5:0.95 of detector against the detections of reference above label_conf as labels, both on
+    # the same fixed shape inputs
+    iouv = torch.linspace(0.5, 0.95, 10)
+    stats = []
+    for frame in frames:
+        img = to_tensor(frame, detector.img_size)
+        labels = non_max_suppression(reference.backend(img), label_conf, reference.iou_thres)[0]
+        pred = non_max_suppression(detector.backend(img), detector.conf_thres, detector.iou_thres)[0]
+        stats.append((match_predictions(pred, labels, iouv), pred[:, 4], pred[:, 5], labels[:, 5]))
+    tp, conf, pred_cls, target_cls = [torch.cat(x, 0).numpy() for x in zip(*stats)]
+    if not len(target_cls):
+        return float('nan'), float('nan')
+    ap = ap_per_class(tp, conf, pred_cls, target_cls)[2]
+    return ap[:, 0].mean(), ap.mean()
+
+
+def head_crops(detector, frames, n=64):
+    # Up to n head crops of the fp32 detector, random crops if it finds none (i.e. untrained weights)
+    crops = []
+    for frame in frames:
+        det = detector.detect(frame)[1]
+        for x1, y1, x2, y2 in det[det[:, 5] == 1, :4].astype(int).tolist():
+            crops.append(frame[y1:y2, x1:x2])
+    crops = [x for x in crops if x.shape[0] >= 5 and x.shape[1] > 0][:n]
+    if not crops:
+        rng = np.random.default_rng(0)
+        crops = [rng.integers(0, 256, (rng.integers(20, 60), rng.integers(20, 60), 3), dtype=np.uint8)
+                 for _ in range(n)]
+    return crops
+
+
+@torch.no_grad()
+def report(detector_weights, classifier_weights, frames, img_size=640, label_conf=0.25, heads=8, n=20):
+    # int8 vs fp32 accuracy and latency side by side
+    fp32, int8 = (Detector(w, device='cpu', img_size=img_size, conf_thres=0.001)
+                  for w in (detector_weights, int8_weights(detector_weights, '.torchscript.pt')))
+    fp32.img_size = int8.img_size = int8.backend.shape[0]  # loading sets the quantized engine of the int8 model
+    map50, map95 = evaluate(int8, fp32, frames, label_conf)
+    img = to_tensor(frames[0], int8.img_size)
+    t_det = [timeit(x.backend, img, n=n) for x in (fp32, int8)]
+
+    fp32.conf_thres = label_conf
+    crops = head_crops(fp32, frames)
+    classifiers = [HelmetClassifier(w, device='cpu') for w in (classifier_weights,
+                                                              int8_weights(classifier_weights, '.pth'))]
+    logits = [x.model(x.preprocess(crops)).float() for x in classifiers]
+    agreement = (logits[0].argmax(1) == logits[1].argmax(1)).float().mean().item()
+    t_cls = [timeit(x.classify_batch, crops[:heads], n=n) for x in classifiers]
+
+    print(f"\n{'model':>12s}{'fp32 (ms)':>12s}{'int8 (ms)':>12s}{'speedup':>10s}  int8 accuracy vs fp32")
+    print(f'{"detector":>12s}{t_det[0]:12.1f}{t_det[1]:12.1f}{t_det[0] / t_det[1]:9.2f}x  '
+          f'mAP@0.5 {map50:.3f}, mAP@0.5:0.95 {map95:.3f} on {len(frames)} frames at {int8.img_size}')
+    print(f'{"classifier":>12s}{t_cls[0]:12.1f}{t_cls[1]:12.1f}{t_cls[0] / t_cls[1]:9.2f}x  '
+          f'{agreement * 100:.1f}% same class on {len(crops)} heads, max logit diff '
+          f'{(logits[0] - logits[1]).abs().max().item():.3f}, batch {heads}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calib', type=str, required=True, help='saved frames (images, videos, directory or glob)')
+    parser.add_argument('--val', type=str, help='frames for the accuracy report, default the calibration frames')
+    parser.add_argument('--calib-frames', type=int, default=200, help='maximum calibration / validation frames')
+    parser.add_argument('--weights', type=str, default='rider_helmet_number_medium.pt', help='detector weights')
+    parser.add_argument('--classifier-weights', type=str, default='helment_no_helmet.pth', help='classifier weights')
+    parser.add_argument('--img-size', type=int, default=640, help='detector input size, fixed in the int8 model')
+    parser.add_argument('--label-conf', type=float, default=0.25, help='confidence of the fp32 pseudo-labels')
+    parser.add_argument('--engine', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack', 'onednn'],
+                        help='quantized engine of the target CPU, qnnpack for ARM')
+    opt = parser.parse_args()
+
+    calib = load_frames(opt.calib, opt.calib_frames)
+    quantize_detector(opt.weights, calib, opt.img_size, opt.engine)
+    quantize_classifier(opt.classifier_weights)
+    report(opt.weights, opt.classifier_weights, load_frames(opt.val, opt.calib_frames) if opt.val else calib,
+           opt.img_size, opt.label_conf)
@@ -0,0 +1,60 @@
+# roi.py
+# Per-camera polygon regions of interest, stored in roi.ini next to config.ini. Detection runs on the ROI bounding
+# rectangle only and boxes whose centre lies outside the polygon are dropped before association
+
+import configparser
+
+import cv2
+import numpy as np
+
+
+class ROI:
+    # Polygon region of interest of a camera, points are (x, y) fractions of the frame width and height so one ROI
+    # fits every resolution (frame, motion mask, ...)
+    def __init__(self, polygon):
+        self.polygon = np.asarray(polygon, dtype=np.float32).reshape(-1, 2).clip(0, 1)
+        assert len(self.polygon) >= 3, f'ROI polygon needs at least 3 points, got {len(self.polygon)}'
+        self.masks = {}  # filled polygon masks per image (h, w)
+
+    def points(self, shape):
+        # Polygon in pixel coordinates of an image of shape (h, w)
+        h, w = shape[:2]
+        return (self.polygon * [w, h]).round().astype(np.int32)
+
+    def rect(self, shape):
+        # Polygon bounding rectangle x1, y1, x2, y2 in pixel coordinates of an image of shape (h, w)
+        h, w = shape[:2]
+        pts = self.points(shape)
+        x1, y1 = pts.min(0)
+        x2, y2 = np.minimum(pts.max(0) + 1, [w, h])
+        return int(x1), int(y1), int(x2), int(y2)
+
+    def crop(self, img):
+        # Crop img to the ROI bounding rectangle, returns the crop and its (x, y) offset in img
+        x1, y1, x2, y2 = self.rect(img.shape)
+        return img[y1:y2, x1:x2], (x1, y1)
+
+    def mask(self, shape):
+        h, w = shape[:2]
+        if (h, w) not in self.masks:
+            self.masks[(h, w)] = cv2.fillPoly(np.zeros((h, w), dtype=np.uint8), [self.points(shape)], 255)
+        return self.masks[(h, w)]
+
+    def contains(self, det, shape):
+        # Bool mask of the (n,6) detections whose box centre lies inside the polygon of an image of shape (h, w)
+        h, w = shape[:2]
+        c = ((det[:, :2] + det[:, 2:4]) / 2).astype(int)
+        return self.mask(shape)[c[:, 1].clip(0, h - 1), c[:, 0].clip(0, w - 1)] > 0
+
+    def draw(self, frame):
+        # Draw the ROI outline on frame
+        return cv2.polylines(frame, [self.points(frame.shape)], True, (255, 255, 0), 1)
+
+
+def load_rois(path='roi.ini'):
+    # {camera: ROI} from the sections of path, the section name is the camera IP/URL as given to main.py and
+    # polygon lists 'x,y' points as fractions of the frame size, i.e. polygon = 0,0.4 1,0.4 1,1 0,1
+    config = configparser.ConfigParser()
+    config.read(path)
+    return {camera: ROI([[float(v) for v in p.split(',')] for p in config.get(camera, 'polygon').split()])
+            for camera in config.sections() if config.has_option(camera, 'polygon')}
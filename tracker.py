@@ -0,0 +1,165 @@
+# tracker.py
+# Lightweight SORT-style rider tracker (constant velocity Kalman filter + greedy IoU matching), CPU only.
+# Every rider gets a track id so its helmet classification can be voted over a few frames and cached, and one
+# best-quality crop is kept per violation instead of saving every frame
+
+import numpy as np
+
+
+def box_iou_np(box1, box2):
+    # (n,m) IoU matrix of xyxy boxes box1(n,4) and box2(m,4)
+    lt = np.maximum(box1[:, None, :2], box2[None, :, :2])
+    rb = np.minimum(box1[:, None, 2:], box2[None, :, 2:])
+    inter = (rb - lt).clip(0).prod(2)
+    area1 = (box1[:, 2:] - box1[:, :2]).prod(1)
+    area2 = (box2[:, 2:] - box2[:, :2]).prod(1)
+    return inter / (area1[:, None] + area2[None] - inter + 1E-9)
+
+
+def xyxy2z(box):
+    # xyxy box to Kalman measurement [cx, cy, area, aspect ratio]
+    w, h = box[2] - box[0], box[3] - box[1]
+    return np.array([box[0] + w / 2, box[1] + h / 2, w * h, w / max(h, 1E-6)])
+
+
+def z2xyxy(x):
+    # Kalman state [cx, cy, area, aspect ratio, ...] to xyxy box
+    w = np.sqrt(max(x[2] * x[3], 0.0))
+    h = x[2] / max(w, 1E-6)
+    return np.array([x[0] - w / 2, x[1] - h / 2, x[0] + w / 2, x[1] + h / 2])
+
+
+class Track:
+    # Tracked rider: Kalman state [cx, cy, area, aspect, vx, vy, varea], helmet votes and best violation crop
+    count = 0  # track ids issued so far
+    F = np.eye(7) + np.eye(7, k=4)  # constant velocity transition
+    H = np.eye(4, 7)  # measurement function
+    Q = np.diag([1, 1, 1, 1, 0.01, 0.01, 0.0001])  # process noise
+    R = np.diag([1, 1, 10, 10])  # measurement noise
+
+    def __init__(self, det, votes=5, max_calls=30):
+        Track.count += 1
+        self.id = Track.count
+        self.x = np.zeros(7)
+        self.x[:4] = xyxy2z(det[:4])
+        self.P = np.diag([10, 10, 10, 10, 1E4, 1E4, 1E4])
+        self.age, self.hits, self.time_since_update = 0, 1, 0
+        self.votes = votes  # confident classifications voted on before the helmet decision is cached
+        self.max_calls = max_calls  # classifications at most, then the decision so far is cached, even if uncertain
+        self.counts = {True: 0, False: 0, None: 0}  # classifications so far per helmet result
+        self.scores = {True: 0.0, False: 0.0, None: 0.0}  # score sums per helmet result
+        self.helmet_present = None  # current [helmet, score], cached once decided
+        self.decided = False
+        self.crops, self.quality = None, 0.0  # best (rider, plate, plate conf) crops while helmet is absent
+
+    def predict(self):
+        if self.x[2] + self.x[6] <= 0:  # keep area positive
+            self.x[6] = 0.0
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        self.age += 1
+        self.time_since_update += 1
+        return z2xyxy(self.x)
+
+    def update(self, det):
+        y = xyxy2z(det[:4]) - self.H @ self.x  # residual
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)  # Kalman gain
+        self.x = self.x + K @ y
+        self.P = (np.eye(7) - K @ self.H) @ self.P
+        self.hits += 1
+        self.time_since_update = 0
+
+    @property
+    def box(self):
+        return z2xyxy(self.x)
+
+    def vote(self, helmet_present):
+        # Add a head classification, the majority of the confident votes is cached once self.votes confident votes
+        # are collected. Uncertain votes (i.e. a distant rider's tiny head) do not count, the rider is classified again
+        # as they come closer, but at most max_calls times, then the decision so far is cached even if uncertain
+        helmet, score = helmet_present
+        self.counts[helmet] += 1
+        self.scores[helmet] += score
+        confident = self.counts[True] + self.counts[False]
+        self.decided = confident >= self.votes or confident + self.counts[None] >= self.max_calls
+        self.helmet_present = self.decision() if self.decided else helmet_present
+
+    def decision(self):
+        # Majority [helmet, mean score] over the confident votes, [None, mean score] if there are none
+        if self.counts[True] or self.counts[False]:
+            helmet = max((True, False), key=self.counts.get)
+        elif self.counts[None]:
+            helmet = None
+        else:
+            return None
+        return [helmet, self.scores[helmet] / self.counts[helmet]]
+
+    def keep_best(self, frame, rider, plate=None):
+        # Keep the rider and plate crops of the best frame so far, quality = rider confidence x rider area
+        quality = float(rider[4] * (rider[2] - rider[0]) * (rider[3] - rider[1]))
+        if quality > self.quality:
+            x1, y1, x2, y2 = rider[:4].astype(int).tolist()
+            rider_img = frame[y1:y2, x1:x2].copy()
+            if plate is not None:
+                x1, y1, x2, y2 = plate[:4].astype(int).tolist()
+                self.crops = rider_img, frame[y1:y2, x1:x2].copy(), float(plate[4])
+            else:
+                self.crops = rider_img, None, 0.0
+            self.quality = quality
+
+    @property
+    def is_violation(self):
+        # Final helmet decision is 'absent' and a crop was kept
+        helmet_present = self.decision()
+        return helmet_present is not None and helmet_present[0] is False and self.crops is not None
+
+
+class Tracker:
+    # SORT-style tracker of rider boxes, update() once per analysed frame
+    def __init__(self, max_age=20, iou_thres=0.3, votes=5, max_calls=30):
+        self.max_age = max_age  # frames a track survives without a matching detection
+        self.iou_thres = iou_thres  # minimum IoU to match a detection to a track
+        self.votes = votes  # confident helmet classifications voted per track
+        self.max_calls = max_calls  # helmet classifications per track at most
+        self.tracks = []
+        self.finished = []  # tracks lost since the last pop_finished()
+
+    def update(self, dets):
+        # Match detections dets(n,4+) xyxy to tracks, returns the track of every detection in input order
+        predicted = np.array([t.predict() for t in self.tracks]).reshape(-1, 4)
+        dets = np.asarray(dets, dtype=np.float32)
+        matches = [None] * len(dets)
+        if len(self.tracks) and len(dets):
+            iou = box_iou_np(predicted, dets[:, :4])
+            used = set()
+            for k in np.argsort(-iou, axis=None):  # greedy, highest IoU first
+                i, j = divmod(int(k), len(dets))
+                if iou[i, j] < self.iou_thres:
+                    break
+                if i not in used and matches[j] is None:
+                    self.tracks[i].update(dets[j])
+                    matches[j] = self.tracks[i]
+                    used.add(i)
+
+        for j, det in enumerate(dets):
+            if matches[j] is None:  # new rider
+                matches[j] = Track(det, self.votes, self.max_calls)
+                self.tracks.append(matches[j])
+
+        alive = []
+        for t in self.tracks:
+            (alive if t.time_since_update <= self.max_age else self.finished).append(t)
+        self.tracks = alive
+        return matches
+
+    def pop_finished(self):
+        # Tracks lost since the last call, their crops and votes are final
+        finished, self.finished = self.finished, []
+        return finished
+
+    def flush(self):
+        # Finish all tracks, i.e. at end of stream
+        self.finished += self.tracks
+        self.tracks = []
+        return self.pop_finished()
@@ -10,7 +10,7 @@ import time
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Lock, Thread
 
 import cv2
 import numpy as np
@@ -258,12 +258,16 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, view=True):
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.view = view  # cv2 windows are shown, 'q' in a window quits
+        self.read_every = 4  # update() stores every read_every-th grabbed frame
 
-        if os.path.isfile(sources):
+        if isinstance(sources, (list, tuple)):
+            sources = list(sources)
+        elif os.path.isfile(sources):
             with open(sources, 'r') as f:
                 sources = [x.strip() for x in f.read().strip().splitlines() if len(x.strip())]
         else:
@@ -271,6 +275,11 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
         n = len(sources)
         self.imgs = [None] * n
+        self.frames = [0] * n  # frames stored per stream so far, a new number is a new frame
+        self.frame_ids = [-1] * n  # self.frames of the images returned by the last __next__()
+        self.stored_fps = [0.0] * n  # rate of the frames stored per stream, camera FPS / read_every
+        self.threads = []
+        self.lock = Lock()  # stores an image and its frame number together
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
@@ -284,12 +293,14 @@ class LoadStreams:  # multiple IP or RTSP cameras
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
+            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100 or 30.0  # 30 FPS fallback, MJPEG streams may report 0
+            self.stored_fps[i] = self.fps / self.read_every
 
             _, self.imgs[i] = cap.read()  # guarantee first frame
             thread = Thread(target=self.update, args=([i, cap]), daemon=True)
             print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
             thread.start()
+            self.threads.append(thread)
         print('')  # newline
 
         # check for common shapes
@@ -299,17 +310,24 @@ class LoadStreams:  # multiple IP or RTSP cameras
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
     def update(self, index, cap):
-        # Read next stream frame in a daemon thread
+        # Read next stream frame in a daemon thread, the thread ends when the stream drops or the file ends
         n = 0
         while cap.isOpened():
             n += 1
             # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
+            if not cap.grab():
+                break
+            if n == self.read_every:  # retrieve every read_every-th grabbed frame
                 success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
+                if not success:
+                    break
+                with self.lock:
+                    self.imgs[index] = im
+                    self.frames[index] += 1
                 n = 0
             time.sleep(1 / self.fps)  # wait time
+        print(f'Stream {self.sources[index]} stopped')
+        cap.release()
 
     def __iter__(self):
         self.count = -1
@@ -317,8 +335,14 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
-        if cv2.waitKey(1) == ord('q'):  # q to quit
+        while self.frames == self.frame_ids and any(x.is_alive() for x in self.threads):
+            time.sleep(1 / self.fps / 4)  # no stream has a new frame yet
+        if self.frames == self.frame_ids:  # every stream reader has stopped
+            raise StopIteration
+        with self.lock:
+            img0 = self.imgs.copy()
+            self.frame_ids = self.frames.copy()
+        if self.view and cv2.waitKey(1) == ord('q'):  # q to quit
             cv2.destroyAllWindows()
             raise StopIteration
 
@@ -848,6 +872,35 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+def letterbox_shape(shape, new_shape=(640, 640), auto=True, stride=32):
+    # Output (height, width) of letterbox() with scaleup=True for an image of shape (height, width, ...)
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+    new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]  # wh padding
+    if auto:  # minimum rectangle
+        dw, dh = np.mod(dw, stride), np.mod(dh, stride)
+    return new_unpad[1] + dh, new_unpad[0] + dw
+
+
+def letterbox_into(img, out, color=(114, 114, 114)):
+    # letterbox() into the preallocated array out(h,w,3), i.e. of letterbox_shape(), without allocating the result
+    shape = img.shape[:2]  # current shape [height, width]
+    assert shape[0] and shape[1], f'letterbox_into() of an empty {shape[1]}x{shape[0]} image'
+    h, w = out.shape[:2]
+    r = min(h / shape[0], w / shape[1])
+    nw, nh = max(int(round(shape[1] * r)), 1), max(int(round(shape[0] * r)), 1)
+    dw, dh = (w - nw) / 2, (h - nh) / 2  # wh padding
+    top, left = int(round(dh - 0.1)), int(round(dw - 0.1))
+    out[:top], out[top + nh:], out[:, :left], out[:, left + nw:] = color, color, color, color  # border
+    if shape != (nh, nw):  # resize
+        cv2.resize(img, (nw, nh), dst=out[top:top + nh, left:left + nw], interpolation=cv2.INTER_LINEAR)
+    else:
+        out[top:top + nh, left:left + nw] = img
+    return (r, r), (dw, dh)
+
+
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
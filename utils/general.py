@@ -452,10 +452,37 @@ def wh_iou(wh1, wh2):
     return inter / (wh1.prod(2) + wh2.prod(2) - inter)  # iou = inter / (area1 + area2 - inter)
 
 
+def topk_candidates(x, topk, multi_label=False, b=None):
+    # Row indices, in input order, of the candidates x(n,5+nc) [xywh, obj, cls...] among the topk most confident of
+    # their class (of their image b(n) if given). topk is an int for every class or a sequence of one int per class.
+    # Ranks obj * cls as non_max_suppression() labels a box, before any box conversion
+    nc = x.shape[1] - 5  # number of classes
+    k = torch.as_tensor(topk, device=x.device).expand(nc)  # per class
+    r = torch.arange(len(x), device=x.device)  # rows
+    if len(x) <= k.min():  # fewer candidates than any limit
+        return r
+    if multi_label:  # every class score
+        conf = (x[:, 5:] * x[:, 4:5]).view(-1)
+        r, j = r.repeat_interleave(nc), torch.arange(nc, device=x.device).repeat(len(x))
+    else:  # best class only
+        conf, j = x[:, 5:].max(1)
+        conf *= x[:, 4]
+    g = j if b is None else b[r] * nc + j  # ranking groups
+    i = conf.argsort(descending=True)
+    i = i[g[i].sort(stable=True)[1]]  # by group, then by confidence
+    n = torch.bincount(g)  # candidates per group
+    i = i[(torch.arange(len(i), device=x.device) - (n.cumsum(0) - n)[g[i]]) < k[j[i]]]  # top-k of every group
+    return r[i].unique()
+
+
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), topk=None, stats=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
+    topk keeps only the topk most confident candidates of every class (int, or a sequence of one int per class)
+    before the confidence and box conversions, which bounds the NMS time of crowded scenes. A stats dict receives the
+    number of candidates above conf_thres, after topk, into NMS and of detections
+
     Returns:
          list of detections, on (n,6) tensor per image [xyxy, conf, cls]
     """
@@ -474,6 +501,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
 
     t = time.time()
     output = [torch.zeros((0, 6), device=prediction.device)] * prediction.shape[0]
+    counts = dict.fromkeys(('candidates', 'topk', 'nms', 'detections'), 0)  # see stats
     for xi, x in enumerate(prediction):  # image index, image inference
         # Apply constraints
         # x[((x[..., 2:4] < min_wh) | (x[..., 2:4] > max_wh)).any(1), 4] = 0  # width-height
@@ -492,6 +520,12 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         if not x.shape[0]:
             continue
 
+        # Top-k candidates of every class
+        counts['candidates'] += x.shape[0]
+        if topk is not None:
+            x = x[topk_candidates(x, topk, multi_label)]
+        counts['topk'] += x.shape[0]
+
         # Compute conf
         x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
 
@@ -520,6 +554,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
             continue
         elif n > max_nms:  # excess boxes
             x = x[x[:, 4].argsort(descending=True)[:max_nms]]  # sort by confidence
+        counts['nms'] += x.shape[0]
 
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
@@ -536,13 +571,86 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
                 i = i[iou.sum(1) > 1]  # require redundancy
 
         output[xi] = x[i]
+        counts['detections'] += i.shape[0]
         if (time.time() - t) > time_limit:
             print(f'WARNING: NMS time limit {time_limit}s exceeded')
             break  # time limit exceeded
 
+    if stats is not None:
+        stats.update(counts)
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, topk=None, stats=None):
+    """Runs Non-Maximum Suppression (NMS) on a batch of inference results in one torchvision call, the detections of
+    non_max_suppression() without its per image loop. Boxes are offset by class and by image index, so one NMS never
+    suppresses across classes or images, and topk / max_nms / max_det still apply per image
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_det = 300  # maximum number of detections per image
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    max_batched = 500  # maximum number of boxes of the batch into one torchvision.ops.nms() on CPU
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image index, candidate index
+    x = prediction[b, k]  # candidates of all images, in image order
+    counts = {'candidates': len(x)}  # see stats
+    if topk is not None:  # top-k candidates of every class
+        i = topk_candidates(x, topk, multi_label, b)
+        x, b = x[i], b[i]
+    counts['topk'] = len(x)
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])  # (center x, center y, width, height) to (x1, y1, x2, y2)
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Excess boxes, sorted by confidence as in non_max_suppression()
+    n = torch.bincount(b, minlength=bs)  # boxes per image
+    if n.max() > max_nms:
+        i = list(torch.arange(len(x), device=x.device).split(n.tolist()))
+        for xi in (n > max_nms).nonzero().view(-1).tolist():
+            i[xi] = i[xi][x[i[xi], 4].argsort(descending=True)[:max_nms]]
+        i = torch.cat(i)
+        x, b, n = x[i], b[i], n.clamp(max=max_nms)
+
+    # Batched NMS
+    counts['nms'] = len(x)
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    if x.is_cuda or len(x) <= max_batched:  # one NMS, boxes also offset by image in fp64 where that offset is exact
+        boxes = boxes.double() + b[:, None] * (max_wh * (1 if agnostic else nc) + max_wh)
+        i = torchvision.ops.nms(boxes, scores.double(), iou_thres)  # sorted by confidence
+        i = i[b[i].sort(stable=True)[1]]  # by image, then by confidence
+    else:  # CPU NMS time is quadratic in its number of boxes, one NMS per image as torchvision.ops.batched_nms()
+        i = torch.cat([torchvision.ops.nms(boxes[j:j + k], scores[j:j + k], iou_thres) + j
+                       for j, k in zip((n.cumsum(0) - n).tolist(), n.tolist()) if k])
+    n = torch.bincount(b[i], minlength=bs)  # detections per image
+    i = i[(torch.arange(len(i), device=x.device) - (n.cumsum(0) - n)[b[i]]) < max_det]  # limit detections
+    if stats is not None:
+        stats.update(counts, detections=len(i))
+    return list(x[i].split(n.clamp(max=max_det).tolist()))
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
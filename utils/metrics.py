@@ -8,6 +8,8 @@ import torch
 
 from . import general
 
+trapz = getattr(np, 'trapezoid', None) or np.trapz  # np.trapz was removed in numpy 2.0
+
 
 def fitness(x):
     # Model fitness as a weighted combination of metrics
@@ -98,7 +100,7 @@ def compute_ap(recall, precision):
     method = 'interp'  # methods: 'continuous', 'interp'
     if method == 'interp':
         x = np.linspace(0, 1, 101)  # 101-point interp (COCO)
-        ap = np.trapz(np.interp(x, mrec, mpre), x)  # integrate
+        ap = trapz(np.interp(x, mrec, mpre), x)  # integrate
     else:  # 'continuous'
         i = np.where(mrec[1:] != mrec[:-1])[0]  # points where x axis (recall) changes
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])  # area under curve
@@ -93,6 +93,14 @@ def time_synchronized():
     return time.time()
 
 
+def inference_mode(mode=True):
+    # torch.inference_mode(mode) context manager / decorator, no autograd graph and no version counter updates, falls
+    # back to torch.no_grad() before torch 1.9. inference_mode(False) re-enables normal tensors, i.e. to load weights
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode(mode)
+    return torch.set_grad_enabled(not mode)
+
+
 def profile(x, ops, n=100, device=None):
     # profile a pytorch module or list of modules. Example usage:
     #     x = torch.randn(16, 3, 640, 640)  # input